@@ -4,37 +4,69 @@ Usage: sporty-cli -h | --help
                           [--min-df=M] [--n-folds=K] [--n-examples=N]
                           [--clf=C [--clf-options=O]] [--proba=P] [--roc=R]
                           [--reduce-func=R] [--features-func=F] [--liwc=L]
+                          [-w W] [--features-cache=D] [--hash-features=N]
+                          [--profile-stages=F] [--clean-memo=T]
        sporty-cli mood label <input_tweets> <labeled_tweets> [-l L]
        sporty-cli mood predict_user <labeled_tweets> <users_dir> <user_ids_file>
                             [-bmptu] [-s SW] [-e E] [--liwc=L]
                             [--forbid=F] [--clf=C [--clf-options=O]]
                             [--proba=P] [--min-df=M] [--reduce-func=R]
                             [--features-func=F] [--sporty] [--poms=P] [--raw]
+                            [-w W] [--features-cache=D] [--hash-features=N]
+                            [--profile-stages=F] [--clean-memo=T]
+                            [--near-duplicates=J]
+       sporty-cli mood score <labeled_tweets> [<input_tweets>] [-bmptu] [-s SW]
+                     [-e E] [-k K] [--liwc=L] [--clf=C [--clf-options=O]]
+                     [--min-df=M] [--reduce-func=R] [--features-func=F]
+                     [--hash-features=N] [--batch=B] [--clean-memo=T]
        sporty-cli mood match_users <sport_scores> <no_sport_scores> <user_match> [--rand=R]
        sporty-cli tweets collect <settings_file> <output_tweets> <track_file>
-                          [<track_file>...] [-c C]
+                          [<track_file>...] [-c C] [--concurrent]
        sporty-cli tweets filter <input_tweets> <output_tweets> <track_file>
-                         [<track_file>...] [-c C] [--each] [--no-rt]
+                         [<track_file>...] [-c C] [--each] [--no-rt] [-w W]
+                         [--concurrent]
+       sporty-cli tweets compact <output_tweets>
+       sporty-cli tweets slim <input_tweets> <output_dir>
        sporty-cli users collect_tweets <settings_file> <user_ids_file> <output_dir>
-                                [-c C]
+                                [-c C] [--compress=Z] [--resume]
        sporty-cli users list_friends <settings_file> <user_ids_file> <output_dir>
        sporty-cli users most_similar <user_ids_file> <users_dir> <friends_dir>
                               [--no-tweets]
        sporty-cli users show <settings_file> <input_dir>
+       sporty-cli users pack <users_dir> <archive_dir>
+       sporty-cli users count <users_dir> [<user_ids_file>] [-w W]
        sporty-cli stream collect <settings_file> [--lang=L] [-c C]
 
 Options:
     -h, --help              Show this screen.
+    --batch=B               Number of tweets whose features are built at once
+                            when scoring a stream of tweets, their scores
+                            being printed once they are all read (1 to print
+                            the score of every tweet as soon as it is read)
+                            [default: 1000]
+    --clean-memo=T          Keep the T last cleaned texts in memory, so that
+                            the repeated texts, e.g. retweets, are cleaned
+                            once by a process
     --clf=C                 Classifier type to use for the task. Valid options
                             are 'logistic-reg', 'svm', 'decision-tree',
                             'naive-bayes', 'kneighbors'
     --clf-options=O         Options for the classifier as a string
                             representing a Python dictionary
+    --compress=Z            Compress the collected tweets using the format Z
+                            amongst 'gzip', 'zstd' and 'lz4'
+    --concurrent            Write the tweets in a segment of the output file
+                            so that other processes can write to the same
+                            output, see 'tweets compact'
     --each                  Filter C tweets for each of the tracked words
+    --features-cache=D      Directory of a cache of the features of the
+                            tweets, reused by the runs with the same cleaning
+                            and features options
     --forbid=F              Path to a file containing a list of forbidden
                             words. If a tweet contains any of these words,
                             it will not be used for the classification
                             task.
+    --hash-features=N       Hash the features of the tweets in N columns
+                            instead of building a vocabulary of the features
     --lang=L                Language of the tweets to collect [default: en]
     --liwc=L                Path to the LIWC dictionary
     --min-df=M              See min_df from sklearn vectorizers [default: 3]
@@ -42,14 +74,22 @@ Options:
                             [default: 0]
     --n-folds=K             Number of folds for the cross validation
                             [default: 10]
+    --near-duplicates=J     Score once the tweets of a user whose features
+                            have an estimated Jaccard similarity of at least
+                            J (e.g. 0.9), numbers being ignored
     --no-rt                 Remove retweets when filtering
     --no-tweets             Do not use the tweets of the users to infer their
                             location
     --poms=P                Path to the poms lexicon
+    --profile-stages=F      Write the numbers of calls and the durations of
+                            the stages of the cleaning and of the features
+                            extraction to the JSON file F
     --proba=P               Classify a tweet as positive only if the
                             probability to be positive is greater than P [default: 0.5]
     --sporty                Flag to put when the users are expected to be exercising.
     --rand=R                Path to file containing the scores of the random users.
+    --resume                Continue the collection of the users whose tweets
+                            have already been partially collected
     --raw                   Flag to put to get the raw results of the classifier (ie,
                             the value printed are those returned by predict_proba from
                             scikit-learn)
@@ -73,11 +113,20 @@ Options:
                             from the corpus
     -t, --top-features      Display the top features during the benchmark
     -u                      Keep URLs when cleaning corpus
+    -w W, --workers=W       Number of processes reading the tweets or
+                            extracting their features, 0 to use one process
+                            per CPU [default: 1]
 """
 import sporty.sporty as sporty
+import sporty.archive as archive
+import sporty.parallel as parallel
+import sporty.slim as slim
+from sporty.cache import FeaturesCache
 from sporty.datastructures import *
+from sporty.duplicates import NearDuplicates
+from sporty.profiling import Profiler
 from sporty.tweets import Tweets
-from sporty.utils import FeaturesBuilder
+from sporty.utils import extractors
 from docopt import docopt
 import sys
 from sklearn.svm import SVC
@@ -87,7 +136,6 @@ from sklearn.tree import DecisionTreeClassifier
 from sklearn.naive_bayes import GaussianNB
 from sklearn.multiclass import OneVsRestClassifier
 import os.path
-from os import listdir
 import logging
 import time
 logging.basicConfig(level=logging.DEBUG,
@@ -100,7 +148,10 @@ logger = logging.getLogger(__name__)
 def main(argv=None):
     args = docopt(__doc__, argv)
     api = sporty.api()
-    if args['tweets']:
+    if args['tweets'] and args['compact']:
+        Segments.compact(args['<output_tweets>'])
+
+    elif args['tweets']:
         # Concatenate the words to track
         totrack = set()
         for i in args['<track_file>']:
@@ -110,30 +161,54 @@ def main(argv=None):
             # Authenticate to the Twitter API
             api.tweets = sporty.tweets.api(args['<settings_file>'])
             api.tweets.collect(totrack, args['<output_tweets>'],
-                               count=int(args['--count']))
+                               count=int(args['--count']),
+                               concurrent=args['--concurrent'] or None)
 
         elif args['filter']:
             api.tweets.load(args['<input_tweets>'])
             api.tweets.filter(int(args['--count']), totrack,
                               each_word=args['--each'],
                               output_file=args['<output_tweets>'],
-                              rt=not args['--no-rt'])
+                              rt=not args['--no-rt'],
+                              workers=int(args['--workers']),
+                              concurrent=args['--concurrent'] or None)
+
+        elif args['slim']:
+            slim.convert(Tweets(args['<input_tweets>'], 'r'),
+                         args['<output_dir>'])
+
+    elif args['users'] and args['pack']:
+        archive.pack(args['<users_dir>'], args['<archive_dir>'])
+
+    elif args['users'] and args['count']:
+        uids = None
+        if args['<user_ids_file>']:
+            uids = LSF(args['<user_ids_file>']).tolist()
+        counts = defaultdict(int)
+        reader = parallel.UsersReader(args['<users_dir>'], uids,
+                                      workers=int(args['--workers']),
+                                      fields=['id'])
+        for uid, batch in reader:
+            counts[uid] += len(batch)
+        for uid in reader.uids:
+            print "%s,%d" % (uid, counts[uid])
 
     elif args['users']:
         # Authenticate to the Twitter API
         api.users = sporty.users.api(args['<user_ids_file>'],
                                      args['<settings_file>'])
         if args['collect_tweets']:
-            api.users.collectTweets(args['<output_dir>'], int(args['--count']))
+            api.users.collectTweets(args['<output_dir>'], int(args['--count']),
+                                    compress=args['--compress'],
+                                    resume=args['--resume'])
 
         elif args['list_friends']:
             api.users.outputFriendsIds(args['<output_dir>'])
 
         elif args['show']:
             files = [os.path.join(args['<input_dir>'], f)
-                     for f in listdir(args['<input_dir>'])
-                     if os.path.isfile(os.path.join(args['<input_dir>'], f))
-                     and f.find('extended') == -1]
+                     for uid, f in Tweets.users_files(args['<input_dir>'])
+                     if f.find('extended') == -1]
             for f in files:
                 if os.path.isfile(f + '.extended'):
                 # friends list already exists for this user
@@ -160,7 +235,7 @@ def main(argv=None):
             api.tweets.label(labels, args['<labeled_tweets>'],
                              int(args['--begin-line']))
 
-        elif args['benchmark'] or args['predict_user']:
+        elif args['benchmark'] or args['predict_user'] or args['score']:
             # Build the right classifier given the CLI options
             classifier_choices = {'logistic-reg': LogisticRegression,
                                   'svm': SVC,
@@ -183,6 +258,16 @@ def main(argv=None):
                 raise Exception("Wrong value for clf: must be amongst "
                                 + str(classifier_choices.keys()))
             api.mood.clf = clf
+            if args['--features-cache']:
+                api.mood.features_cache = \
+                    FeaturesCache.open(args['--features-cache'])
+            if args['--profile-stages']:
+                api.mood.profiler = Profiler()
+            if args['--clean-memo']:
+                api.mood.cleaner_memo = LRUCache(int(args['--clean-memo']))
+            if args['--near-duplicates']:
+                api.mood.near_duplicates = \
+                    NearDuplicates(float(args['--near-duplicates']))
 
             # Build the cleaner options, the TF-IDF vectorizer options,
             # and the FeaturesBuilder options.
@@ -199,9 +284,9 @@ def main(argv=None):
             if args['--features-func']:
                 func_list = eval(args['--features-func'])
                 for f in func_list:
-                    if f not in dir(FeaturesBuilder):
-                        raise Exception(f + " is not a function of "
-                                        + "FeaturesBuilder.")
+                    if f != 'clean' and f not in extractors:
+                        raise Exception(f + " is not a features extractor "
+                                        + "of FeaturesBuilder.")
             else:
                 func_list = None
             # get the reducing function
@@ -212,7 +297,9 @@ def main(argv=None):
             fb_options = {"labels": keys,
                           "labels_reduce_f": reduce_func,
                           "func_list": func_list,
-                          "liwc_path": args['--liwc']}
+                          "liwc_path": args['--liwc'],
+                          "workers": int(args['--workers']),
+                          "n_features": int(args['--hash-features'] or 0)}
 
             # Load the tweets
             tweets = Tweets(args['<labeled_tweets>'])
@@ -229,10 +316,13 @@ def main(argv=None):
             argproba = float(args['--proba'])
             if args['benchmark']:
                 # Run the benchmark
-                return args, api.mood.benchmark(int(args['--n-folds']),
-                                                int(args['--n-examples']),
-                                                args['--top-features'],
-                                                argproba)
+                stats = api.mood.benchmark(int(args['--n-folds']),
+                                           int(args['--n-examples']),
+                                           args['--top-features'],
+                                           argproba)
+                if args['--profile-stages']:
+                    api.mood.profiler.dump(args['--profile-stages'])
+                return args, stats
             elif args['predict_user']:
                 user_ids = LSF(args['<user_ids_file>']).tolist()
                 forbidden_words = set(LSF(args['--forbid']).tolist())
@@ -240,13 +330,30 @@ def main(argv=None):
                 if args['--poms']:
                     poms = TSV(args['--poms'])
                 raw_scores = bool(args['--raw'])
-                return api.mood.classifyUser(args['<users_dir>'],
-                                             user_ids,
-                                             forbidden_words,
-                                             argproba,
-                                             args['--sporty'],
-                                             poms,
-                                             raw_scores)
+                scores = api.mood.classifyUser(args['<users_dir>'],
+                                               user_ids,
+                                               forbidden_words,
+                                               argproba,
+                                               args['--sporty'],
+                                               poms,
+                                               raw_scores)
+                if args['--profile-stages']:
+                    api.mood.profiler.dump(args['--profile-stages'])
+                return scores
+            elif args['score']:
+                # score the tweets of a file or of the standard input, e.g.
+                # the output of 'stream collect', by batches
+                if args['<input_tweets>']:
+                    stream = Tweets(args['<input_tweets>'], 'r')
+                else:
+                    stream = (json.loads(line)
+                              for line in iter(sys.stdin.readline, '')
+                              if line.strip())
+                for tw, scores in api.mood.scoreStream(stream,
+                                                       int(args['--batch'])):
+                    print ",".join([str(tw.get('id_str', tw.get('id')))]
+                                   + map(str, scores))
+                    sys.stdout.flush()
         elif args['match_users']:
             return api.mood.match_users(args['<sport_scores>'],
                                         args['<no_sport_scores>'],
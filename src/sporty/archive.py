@@ -0,0 +1,297 @@
+""" Packed archive of the tweets of many users.
+
+An archive stores the timelines of users in a directory containing:
+    - meta.json: format, version and maximum size of the segments
+    - segment-<n>.jsonl: large files of JSON tweets, one tweet per line
+    - index: one line "uid segment offset length count" per extent, an extent
+      being a group of consecutive tweets of a user written in a segment
+
+The tweets of a user are the concatenation of its extents in the order of the
+index, so collecting more tweets for a user only appends to the last segment
+and to the index. The path <archive_dir>/<uid> of a user can be given to
+Tweets instead of the path of a file of the one-file-per-user layout.
+An archive supports any number of readers but only one writing process.
+"""
+
+import json
+import os
+from collections import defaultdict
+from compression import open_file
+from decoder import Decoder
+
+FORMAT = 'sporty-archive'
+VERSION = 1
+SEGMENT_SIZE = 1 << 30
+INDEX = 'index'
+
+
+class Archive(object):
+    """
+    Reads and appends the tweets of users stored in an archive. Archives are
+    opened once per process with Archive.open.
+    """
+    opened = {}
+
+    def __init__(self, directory, segment_size=SEGMENT_SIZE):
+        """
+        Creates the archive if the directory does not contain one.
+
+        Parameters:
+        directory    - directory of the archive
+        segment_size - size in bytes from which a new segment is started,
+                       only used when the archive is created
+        """
+        super(Archive, self).__init__()
+        self.directory = directory
+        meta_path = os.path.join(directory, 'meta.json')
+        if not os.path.isfile(meta_path):
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            with open(meta_path, 'w') as f:
+                json.dump({'format': FORMAT, 'version': VERSION,
+                           'segment_size': segment_size}, f)
+        with open(meta_path) as f:
+            self.meta = json.load(f)
+        self.segment_size = self.meta['segment_size']
+        self.index_path = os.path.join(directory, INDEX)
+        self.index_pos = 0      # bytes of the index already loaded
+        self.extents = defaultdict(list)
+        self.segment = 0        # last segment written
+        self.readers = {}       # opened segments
+        self.pid = os.getpid()  # process owning the opened segments
+        self.refresh()
+
+    @classmethod
+    def open(cls, directory):
+        """
+        Return value:
+        The archive stored in the given directory, up to date with its index.
+        The instance is shared by all the callers of the process.
+        """
+        key = os.path.realpath(directory)
+        if key not in cls.opened:
+            cls.opened[key] = cls(directory)
+        archive = cls.opened[key]
+        archive.refresh()
+        return archive
+
+    @classmethod
+    def is_archive(cls, path):
+        """
+        Return value:
+        True if the given path is the directory of an archive, False
+        otherwise.
+        """
+        if os.path.realpath(path) in cls.opened:
+            return True
+        meta_path = os.path.join(path, 'meta.json')
+        if not os.path.isfile(meta_path):
+            return False
+        with open(meta_path) as f:
+            try:
+                return json.load(f).get('format') == FORMAT
+            except ValueError:
+                return False
+
+    def refresh(self):
+        """
+        Loads the extents added to the index since the last call, possibly by
+        another process.
+        """
+        if not os.path.isfile(self.index_path):
+            return
+        with open(self.index_path, 'rb') as f:
+            f.seek(self.index_pos)
+            for line in f:
+                if not line.endswith('\n'):
+                    break  # record being written
+                self.index_pos += len(line)
+                uid, segment, offset, length, count = line.split()
+                segment = int(segment)
+                self.extents[uid].append((segment, int(offset), int(length),
+                                          int(count)))
+                self.segment = max(self.segment, segment)
+
+    def __contains__(self, uid):
+        return str(uid) in self.extents
+
+    def __len__(self):
+        return len(self.extents)
+
+    def uids(self):
+        """
+        Return value:
+        The list of the users stored in the archive.
+        """
+        return self.extents.keys()
+
+    def count(self, uid):
+        """
+        Return value:
+        The number of tweets stored for the given user.
+        """
+        return sum(e[3] for e in self.extents.get(str(uid), []))
+
+    def segment_path(self, segment):
+        return os.path.join(self.directory, 'segment-%05d.jsonl' % segment)
+
+    def read(self, extent):
+        """
+        Return value:
+        The lines of the tweets of the given extent.
+        """
+        segment, offset, length, count = extent
+        if self.pid != os.getpid():
+            # forked process: do not share file positions with the parent
+            self.readers = {}
+            self.pid = os.getpid()
+        if segment not in self.readers:
+            self.readers[segment] = open(self.segment_path(segment), 'rb')
+        f = self.readers[segment]
+        f.seek(offset)
+        return f.read(length).split('\n')[:-1]
+
+    def append(self, uid, lines):
+        """
+        Writes tweets of a user in a new extent at the end of the last
+        segment, or of a new segment if the last one is full.
+
+        Parameters:
+        uid   - identifier of the user
+        lines - JSON encoded tweets, each one ending with a newline
+        """
+        if not lines:
+            return
+        data = ''.join(lines)
+        path = self.segment_path(self.segment)
+        if os.path.isfile(path) \
+                and os.path.getsize(path) + len(data) > self.segment_size:
+            self.segment += 1
+            path = self.segment_path(self.segment)
+        with open(path, 'ab') as f:
+            f.seek(0, os.SEEK_END)
+            offset = f.tell()
+            f.write(data)
+        # the extent is only visible once its tweets are on disk
+        with open(self.index_path, 'ab') as f:
+            f.write("%s %d %d %d %d\n" % (uid, self.segment, offset,
+                                          len(data), len(lines)))
+        self.refresh()
+
+    def user(self, uid, decoder=None):
+        """
+        Return value:
+        A sequence of the tweets of the given user, see UserTweets.
+        """
+        return UserTweets(self, uid, decoder)
+
+    def close(self):
+        for f in self.readers.values():
+            f.close()
+        self.readers = {}
+
+
+class UserTweets(object):
+    """
+    Sequence of the tweets of a user stored in an archive, used by Tweets.
+    Tweets are read extent by extent, so iterating over the tweets of a user
+    costs one read per extent.
+    """
+    def __init__(self, archive, uid, decoder=None):
+        """
+        Parameters:
+        archive - the archive storing the tweets
+        uid     - identifier of the user
+        decoder - decoder of the tweets (see decoder.Decoder)
+        """
+        super(UserTweets, self).__init__()
+        self.archive = archive
+        self.uid = str(uid)
+        self.decoder = decoder if decoder else Decoder()
+        self.cached = (None, [])    # last extent read and its lines
+
+    def extents(self):
+        return self.archive.extents.get(self.uid, [])
+
+    def _lines(self, extent):
+        if self.cached[0] != extent:
+            self.cached = (extent, self.archive.read(extent))
+        return self.cached[1]
+
+    def __len__(self):
+        return sum(e[3] for e in self.extents())
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if i >= 0:
+            for e in self.extents():
+                if i < e[3]:
+                    return self.decoder(self._lines(e)[i])
+                i -= e[3]
+        raise IndexError("tweet index out of range")
+
+    def __iter__(self):
+        for e in self.extents():
+            for line in self._lines(e):
+                yield self.decoder(line)
+
+    def extend(self, lines):
+        """
+        Appends JSON encoded tweets, each one ending with a newline.
+        """
+        self.archive.append(self.uid, lines)
+
+
+def locate(path):
+    """
+    Return value:
+    The pair (archive, uid) if the given path is the path of a user in an
+    archive, None otherwise.
+    """
+    directory, uid = os.path.split(path)
+    if uid and Archive.is_archive(directory or '.'):
+        return Archive.open(directory or '.'), uid
+    return None
+
+
+def find_user(path):
+    """
+    Return value:
+    The given path if it is the path of a user whose tweets are stored in an
+    archive, None otherwise.
+    """
+    located = locate(path)
+    if located and located[1] in located[0]:
+        return path
+    return None
+
+
+def pack(users_dir, directory, skip=('.extended',)):
+    """
+    Converts a directory containing one file of tweets per user (possibly
+    compressed) to an archive. Users already stored in the archive are
+    skipped, so a conversion can be resumed.
+
+    Parameters:
+    users_dir - directory of the files of tweets, named after the user ids
+    directory - directory of the archive, created if needed
+    skip      - extensions of the files of users_dir that are not tweets
+
+    Return value:
+    The number of users added to the archive.
+    """
+    # datastructures imports this module
+    from datastructures import Tweets
+    archive = Archive.open(directory)
+    added = 0
+    for uid, name in Tweets.users_files(users_dir, skip):
+        path = os.path.join(users_dir, name)
+        if uid in archive:
+            continue
+        with open_file(path, 'r') as f:
+            lines = [l if l.endswith('\n') else l + '\n' for l in f if l.strip()]
+        if lines:
+            archive.append(uid, lines)
+            added += 1
+    return added
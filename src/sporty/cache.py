@@ -0,0 +1,219 @@
+""" Persistent cache of the features of tweets.
+
+The features extracted from a tweet by a FeaturesBuilder only depend on the
+tweet and on the options of the cleaner and of the builder. A cache stores
+them in a directory containing one file per configuration of these options,
+named after a hash of the configuration (the files given as options, e.g.
+the stopwords or the LIWC dictionary, are hashed by content):
+    - <configuration>.jsonl: one line [key, features, text] per tweet, key
+      being a hash of the id and of the text of the tweet, features the
+      features of the tweet joined by spaces (null if the tweet is filtered)
+      and text the text of the tweet once cleaned by the builder
+
+The least recently used configurations are removed when the files of the
+cache exceed its maximum size, so that runs repeated with the same options,
+e.g. the benchmarks of a parameters sweep, extract the features of every
+tweet only once.
+"""
+
+import hashlib
+import json
+import logging
+import os
+
+VERSION = 2
+MAX_SIZE = 1 << 28
+EXTENSION = '.jsonl'
+
+
+def file_hash(path):
+    """
+    Return value:
+    The hash of the content of the given file, None if there is no file.
+    """
+    if not path:
+        return None
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), ''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def tweet_key(tw):
+    """
+    Return value:
+    The key of a tweet in the cache, a hash of its id and of its text.
+
+    >>> key = tweet_key({'id_str': u'1', 'text': u'caf\\xe9'})
+    >>> key == tweet_key({'id': 1, 'text': 'caf\\xc3\\xa9'})
+    True
+    """
+    twid, text = tw.get('id_str', tw.get('id')), tw['text']
+    if isinstance(twid, unicode):
+        twid = twid.encode('utf-8')
+    if isinstance(text, unicode):
+        text = text.encode('utf-8')
+    return hashlib.sha1("%s\n%s" % (twid, text)).hexdigest()
+
+
+class FeaturesCache(object):
+    """
+    Cache of the features of tweets stored in a directory. Caches are opened
+    once per process with FeaturesCache.open, the features of the
+    configurations being loaded once.
+    """
+    opened = {}
+
+    def __init__(self, directory, max_size=MAX_SIZE):
+        """
+        Parameters:
+        directory - directory of the cache, created if needed
+        max_size  - size in bytes of the files of the cache from which the
+                    least recently used configurations are removed
+        """
+        super(FeaturesCache, self).__init__()
+        self.directory = directory
+        self.max_size = max_size
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.entries = {}   # loaded configurations
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def open(cls, directory, max_size=MAX_SIZE):
+        """
+        Return value:
+        The cache stored in the given directory. The instance is shared by all
+        the callers of the process.
+        """
+        key = os.path.realpath(directory)
+        if key not in cls.opened:
+            cls.opened[key] = cls(directory, max_size)
+        return cls.opened[key]
+
+    def configuration(self, cleaner_options, fb):
+        """
+        Return value:
+        The hash identifying the configuration of the given cleaner options
+        and features builder.
+        """
+        options = dict(cleaner_options)
+        for name in ('stopwords', 'emoticons'):
+            options[name] = file_hash(options.get(name))
+        conf = {'version': VERSION,
+                'cleaner': options,
+                'func_list': fb.func_list,
+                'keep_rt': fb.keep_rt,
+                'mini': fb.mini,
+                'maxi': fb.maxi,
+                'liwc': file_hash(fb.liwc_path)}
+        return hashlib.sha1(json.dumps(conf, sort_keys=True)).hexdigest()
+
+    def path(self, conf):
+        return os.path.join(self.directory, conf + EXTENSION)
+
+    def load(self, conf):
+        """
+        Return value:
+        The dictionary of the features and texts of the tweets cached for the
+        given configuration, by key.
+        """
+        if conf not in self.entries:
+            entries = {}
+            path = self.path(conf)
+            if os.path.isfile(path):
+                with open(path, 'rb') as f:
+                    for line in f:
+                        try:
+                            key, features, text = json.loads(line)
+                        except ValueError:
+                            continue  # line being written
+                        entries[key] = (features, text)
+                os.utime(path, None)  # recently used
+            self.entries[conf] = entries
+        return self.entries[conf]
+
+    def store(self, conf, items):
+        """
+        Adds the pairs (key, (features, text)) of tweets to a configuration.
+        """
+        if not items:
+            return
+        self.load(conf).update(items)
+        lines = [json.dumps([key, features, text]) + '\n'
+                 for key, (features, text) in items]
+        with open(self.path(conf), 'ab') as f:
+            f.write(''.join(lines))
+        self.evict(conf)
+
+    def evict(self, current=None):
+        """
+        Removes the least recently used configurations, except the current
+        one, until the files of the cache fit in its maximum size.
+        """
+        files = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith(EXTENSION) and os.path.isfile(path):
+                st = os.stat(path)
+                files.append((st.st_mtime, st.st_size, name[:-len(EXTENSION)]))
+        size = sum(f[1] for f in files)
+        for mtime, fsize, conf in sorted(files):
+            if size <= self.max_size:
+                break
+            if conf == current:
+                continue
+            try:
+                os.remove(self.path(conf))
+            except OSError, e:
+                logging.warning("Cannot remove %s from the features cache: %s"
+                                % (conf, e))
+                continue
+            self.entries.pop(conf, None)
+            size -= fsize
+
+    def run(self, fb, cleaner_options):
+        """
+        Extracts the features and the labels of the corpus of a features
+        builder as FeaturesBuilder.run does, only the tweets that are not in
+        the cache being given to the builder. The texts of the cached tweets
+        are replaced by their cleaned texts, as the builder does.
+
+        Parameters:
+        fb              - the features builder
+        cleaner_options - options of the cleaner of the builder
+
+        Return value:
+        The triple (features, labels, twids), see FeaturesBuilder.run.
+        """
+        conf = self.configuration(cleaner_options, fb)
+        entries = self.load(conf)
+        corpus = list(fb.corpus)
+        keys = [tweet_key(tw) for tw in corpus]
+        missing = [(key, tw) for key, tw in zip(keys, corpus)
+                   if key not in entries]
+        self.hits += len(corpus) - len(missing)
+        self.misses += len(missing)
+        if missing:
+            fb.corpus = [tw for key, tw in missing]
+            features = iter(fb.run()[0])
+            fb.corpus = corpus
+            self.store(conf, [(key, (next(features) if kept else None,
+                                     tw['text']))
+                              for (key, tw), kept in zip(missing, fb.twids)])
+
+        fb.features, fb.labels, fb.twids = [], [], []
+        for key, tw in zip(keys, corpus):
+            features, text = entries[key]
+            tw['text'] = text
+            if features is None:
+                fb.twids.append(0)
+                continue
+            fb.features.append(features)
+            d = fb.label(tw)
+            if d is not None:
+                fb.labels.append(d)
+            fb.twids.append(1)
+        return fb.features, fb.labels, fb.twids
@@ -0,0 +1,278 @@
+''' Transparent compressed storage of tweets files.
+
+Compressed files are written as a sequence of independent blocks (gzip
+members, zstd frames or lz4 frames) of at most BLOCK_SIZE uncompressed bytes,
+cut at line boundaries. The result is a valid gzip/zstd/lz4 stream that can
+still be appended to, by adding blocks at the end of the file, and that can
+be read from any line: as in BGZF, positions in the file are virtual offsets
+made of the offset of a block in the compressed file (upper bits) and of the
+position in the uncompressed block (lower POS_BITS bits). Files compressed by
+other tools are read the same way as long as their blocks (usually a single
+one) are smaller than 2^POS_BITS bytes once uncompressed.
+'''
+
+import os
+import zlib
+
+BLOCK_SIZE = 0xff00
+POS_BITS = 24
+POS_MASK = (1 << POS_BITS) - 1
+
+
+class Codec(object):
+    """
+    Compression format of a tweets file.
+    """
+    def __init__(self, name, extension, magic, compress, decompressor):
+        """
+        Parameters:
+        name         - name of the format
+        extension    - extension of the files using this format
+        magic        - first bytes of the files using this format
+        compress     - function compressing a block in an independent frame
+        decompressor - function returning a streaming decompressor exposing
+                       decompress(data) and unused_data
+        """
+        super(Codec, self).__init__()
+        self.name = name
+        self.extension = extension
+        self.magic = magic
+        self.compress = compress
+        self.decompressor = decompressor
+
+
+def gzip_compress(data):
+    c = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return c.compress(data) + c.flush()
+
+CODECS = [Codec('gzip', '.gz', '\x1f\x8b', gzip_compress,
+                lambda: zlib.decompressobj(16 + zlib.MAX_WBITS))]
+try:
+    import zstandard
+    CODECS.append(Codec('zstd', '.zst', '\x28\xb5\x2f\xfd',
+                        lambda data: zstandard.ZstdCompressor().compress(data),
+                        lambda: zstandard.ZstdDecompressor().decompressobj()))
+except ImportError:
+    pass
+try:
+    import lz4.frame
+    CODECS.append(Codec('lz4', '.lz4', '\x04\x22\x4d\x18', lz4.frame.compress,
+                        lz4.frame.LZ4FrameDecompressor))
+except ImportError:
+    pass
+# formats recognized even when the library needed to read them is missing
+KNOWN_FORMATS = {'.gz': '\x1f\x8b', '.zst': '\x28\xb5\x2f\xfd',
+                 '.lz4': '\x04\x22\x4d\x18'}
+
+
+def get_codec(name):
+    """
+    Return value:
+    The codec with the given name or extension.
+    """
+    for c in CODECS:
+        if name in (c.name, c.extension):
+            return c
+    raise Exception("Compression format %s not available: must be amongst %s"
+                    % (name, repr([c.name for c in CODECS])))
+
+
+def detect(path):
+    """
+    Return value:
+    The codec of the given file using its first bytes if it is not empty, or
+    its extension otherwise. None if the file is not compressed.
+    """
+    magic = ''
+    if os.path.isfile(path):
+        with open(path, 'rb') as f:
+            magic = f.read(4)
+    for ext, ext_magic in KNOWN_FORMATS.iteritems():
+        if magic.startswith(ext_magic) or (not magic and path.endswith(ext)):
+            return get_codec(ext)
+    return None
+
+
+def find(path):
+    """
+    Return value:
+    The path of the file storing the given path, either the path itself or
+    the path with the extension of a compression format. None if no such
+    file exists.
+    """
+    if os.path.isfile(path):
+        return path
+    for ext in KNOWN_FORMATS:
+        if os.path.isfile(path + ext):
+            return path + ext
+    return None
+
+
+def open_file(path, mode='r'):
+    """
+    Opens a tweets file, compressed or not.
+
+    Return value:
+    A file object, or a BlockFile if the file is compressed.
+    """
+    codec = detect(path)
+    if codec is None:
+        return open(path, mode)
+    return BlockFile(path, mode, codec)
+
+
+class BlockFile(object):
+    """
+    File-like object reading and appending lines in a block-compressed file.
+    tell() and seek() use virtual offsets, see the module documentation.
+    """
+    chunk_size = 1 << 14
+    raw_modes = {'r': 'rb', 'w': 'w+b', 'w+': 'w+b', 'a': 'ab', 'a+': 'a+b',
+                 'r+': 'r+b'}
+
+    def __init__(self, path, mode, codec):
+        """
+        Parameters:
+        path  - path of the compressed file
+        mode  - opening mode, as for the built-in open
+        codec - compression format of the file
+        """
+        super(BlockFile, self).__init__()
+        self.name = path
+        self.mode = mode
+        self.codec = codec
+        self.raw = open(path, self.raw_modes.get(mode.replace('b', ''), 'a+b'))
+        self.pending = []       # uncompressed data waiting to be written
+        self.loaded = False
+        self.block_offset = 0   # offset of the current block in the file
+        self.next_offset = 0    # offset of the block following it
+        self.block_data = ''    # uncompressed current block
+        self.block_pos = 0      # position in the uncompressed current block
+
+    def _load_block(self, offset):
+        """
+        Decompresses the block starting at the given offset of the file.
+        """
+        self.raw.seek(offset)
+        d = self.codec.decompressor()
+        data = []
+        read = 0
+        while not d.unused_data and not getattr(d, 'eof', False):
+            chunk = self.raw.read(self.chunk_size)
+            if not chunk:
+                break
+            read += len(chunk)
+            data.append(d.decompress(chunk))
+        self.loaded = True
+        self.block_offset = offset
+        self.next_offset = offset + read - len(d.unused_data)
+        self.block_data = ''.join(data)
+        self.block_pos = 0
+
+    def _blocks(self, data):
+        """
+        Splits data in blocks of at most BLOCK_SIZE bytes, cut at the end of a
+        line when possible.
+        """
+        start = 0
+        while start < len(data):
+            end = min(start + BLOCK_SIZE, len(data))
+            if end < len(data):
+                cut = data.rfind('\n', start, end)
+                if cut != -1:
+                    end = cut + 1
+            yield data[start:end]
+            start = end
+
+    def readline(self):
+        if self.pending:
+            self.flush()
+        parts = []
+        while True:
+            i = self.block_data.find('\n', self.block_pos)
+            if i != -1:
+                parts.append(self.block_data[self.block_pos:i + 1])
+                self.block_pos = i + 1
+                break
+            parts.append(self.block_data[self.block_pos:])
+            offset = self.next_offset
+            self._load_block(offset)
+            if self.next_offset == offset:  # end of file
+                break
+        return ''.join(parts)
+
+    def __iter__(self):
+        while True:
+            line = self.readline()
+            if not line:
+                return
+            yield line
+
+    def tell(self):
+        if self.loaded and self.block_pos >= len(self.block_data):
+            return self.next_offset << POS_BITS
+        if self.block_pos > POS_MASK:
+            raise IOError("Block too large to address a position in %s, the "
+                          "file should be compressed again using Tweets."
+                          % self.name)
+        return (self.block_offset << POS_BITS) | self.block_pos
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_END:
+            self._load_block(self.rawsize())
+        else:
+            if self.pending:
+                self.flush()
+            if not self.loaded or offset >> POS_BITS != self.block_offset:
+                self._load_block(offset >> POS_BITS)
+            self.block_pos = offset & POS_MASK
+
+    def rawsize(self):
+        """
+        Return value:
+        The size of the compressed file.
+        """
+        self.flush()
+        self.raw.seek(0, os.SEEK_END)
+        return self.raw.tell()
+
+    def line_offsets(self, start, end):
+        """
+        Yields the virtual offsets of the lines starting in the blocks located
+        between the offsets start and end of the compressed file.
+        """
+        self.seek(start << POS_BITS)
+        while True:
+            pos = self.tell()
+            if pos >> POS_BITS >= end or not self.readline():
+                return
+            yield pos
+
+    def write(self, data):
+        self.pending.append(data)
+
+    def flush(self):
+        """
+        Compresses the written data in new blocks appended to the file.
+        """
+        if self.pending:
+            data = ''.join(self.pending)
+            self.pending = []
+            self.raw.seek(0, os.SEEK_END)
+            for block in self._blocks(data):
+                self.raw.write(self.codec.compress(block))
+        self.raw.flush()
+
+    def fileno(self):
+        return self.raw.fileno()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def close(self):
+        self.flush()
+        self.raw.close()
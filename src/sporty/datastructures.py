@@ -1,28 +1,521 @@
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 import json
+import mmap
 import os
 import re
+import socket
+import struct
 import sys
+import time
 import logging
+from archive import UserTweets, locate
+from compression import KNOWN_FORMATS, find, open_file
+from decoder import Decoder
+from slim import SlimCorpus
+
+class LineIndex(object):
+	"""
+	Index of the byte offset at which every line of a tweets file starts, so
+	that any tweet can be reached with a single seek instead of reading the
+	file from the beginning.
+	The index is stored in a sidecar file next to the indexed file (same name
+	with the .idx extension) and memory-mapped when read. It is built once
+	and then extended when the indexed file grows. When the sidecar cannot be
+	written, the offsets are kept in memory.
+	"""
+	extension = '.idx'
+	magic = 'SPTYIDX1'
+	header = struct.Struct('<8sQQ')	# magic, indexed bytes, indexed lines
+	entry = struct.Struct('<Q')
+	chunk_size = 1 << 20
+
+	def __init__(self, fileobj, path=None):
+		"""
+		Parameters:
+		fileobj - opened file containing one JSON tweet per line.
+		path    - path of the indexed file, None to keep the index in memory.
+		"""
+		super(LineIndex, self).__init__()
+		self.fileobj = fileobj
+		self.path = path + self.extension if path else None
+		self.offsets = None	# mmap of the sidecar file or list of offsets
+		self.count = 0
+		self.covered = 0	# number of bytes of the file already indexed
+
+	def __len__(self):
+		return self.count
+
+	def __getitem__(self, i):
+		"""
+		Return value:
+		The byte offset at which the i-th line starts.
+		"""
+		if i < 0:
+			i += self.count
+		if i < 0 or i >= self.count:
+			raise IndexError("line index out of range")
+		if type(self.offsets) == list:
+			return self.offsets[i]
+		pos = self.header.size + i * self.entry.size
+		return self.entry.unpack_from(self.offsets, pos)[0]
+
+	def _filesize(self):
+		self.fileobj.flush()
+		if hasattr(self.fileobj, 'rawsize'):
+			return self.fileobj.rawsize()
+		self.fileobj.seek(0, os.SEEK_END)
+		return self.fileobj.tell()
+
+	def _scan(self, start, end):
+		"""
+		Reads the bytes of the indexed file between start and end and returns
+		the offsets of the lines starting in this range. For compressed files,
+		these are the virtual offsets of the lines (see compression.BlockFile).
+		"""
+		if hasattr(self.fileobj, 'line_offsets'):
+			return list(self.fileobj.line_offsets(start, end))
+		offsets = []
+		if start == 0:
+			at_line_start = True
+		else:
+			self.fileobj.seek(start - 1)
+			at_line_start = self.fileobj.read(1) == "\n"
+		if at_line_start and start < end:
+			offsets.append(start)
+		self.fileobj.seek(start)
+		pos = start
+		while pos < end:
+			chunk = self.fileobj.read(min(self.chunk_size, end - pos))
+			if not chunk:
+				break
+			i = chunk.find("\n")
+			while i != -1:
+				if pos + i + 1 < end:
+					offsets.append(pos + i + 1)
+				i = chunk.find("\n", i + 1)
+			pos += len(chunk)
+		return offsets
+
+	def _open_sidecar(self, size):
+		"""
+		Maps the existing sidecar file if it is consistent with the indexed
+		file.
+
+		Return value:
+		True if the sidecar has been mapped, False otherwise.
+		"""
+		if not self.path or not os.path.isfile(self.path):
+			return False
+		with open(self.path, 'rb') as f:
+			head = f.read(self.header.size)
+			if len(head) != self.header.size:
+				return False
+			magic, covered, count = self.header.unpack(head)
+			f.seek(0, os.SEEK_END)
+			entries = (f.tell() - self.header.size) // self.entry.size
+			if magic != self.magic or covered > size or count > entries:
+				return False
+			if covered and not hasattr(self.fileobj, 'line_offsets'):
+				# the indexed part must still end with a complete line
+				self.fileobj.seek(covered - 1)
+				if self.fileobj.read(1) != "\n":
+					return False
+			self.offsets = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		self.count = count
+		self.covered = covered
+		return True
+
+	def _extend(self, offsets, covered, rebuild=False):
+		"""
+		Adds offsets to the index and writes them in the sidecar file, or in
+		memory if the sidecar cannot be written.
+		"""
+		if rebuild:
+			self.close()
+			self.count = 0
+		if self.path and type(self.offsets) != list:
+			try:
+				mode = 'w+b' if self.offsets is None else 'r+b'
+				with open(self.path, mode) as f:
+					if self.offsets is None:
+						f.write(self.header.pack(self.magic, 0, 0))
+					f.seek(self.header.size + self.count * self.entry.size)
+					f.write(''.join(self.entry.pack(o) for o in offsets))
+					f.truncate()
+					# the header is updated last so that an interrupted
+					# write leaves a consistent index
+					f.seek(0)
+					f.write(self.header.pack(self.magic, covered,
+											 self.count + len(offsets)))
+					f.flush()
+					mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+			except (IOError, OSError), e:
+				logging.warning("Cannot write line index %s: %s" % (self.path, e))
+				self.offsets = [self[i] for i in range(self.count)]
+			else:
+				self.close()
+				self.offsets = mapped
+				self.count += len(offsets)
+				self.covered = covered
+				return
+		if self.offsets is None:
+			self.offsets = []
+		self.offsets.extend(offsets)
+		self.count += len(offsets)
+		self.covered = covered
+
+	def refresh(self):
+		"""
+		Makes sure the index covers the whole file: loads the sidecar file if
+		needed, indexes the lines appended since the last refresh, and
+		rebuilds the index if the file has been truncated.
+
+		Return value:
+		The number of indexed lines.
+		"""
+		pos = self.fileobj.tell()
+		try:
+			size = self._filesize()
+			if self.offsets is None:
+				self._open_sidecar(size)
+			if self.offsets is None or self.covered > size:
+				self._extend(self._scan(0, size), size, rebuild=True)
+			elif self.covered < size:
+				self._extend(self._scan(self.covered, size), size)
+		finally:
+			self.fileobj.seek(pos)
+		return self.count
+
+	def close(self):
+		if self.offsets is not None and type(self.offsets) != list:
+			self.offsets.close()
+		self.offsets = None
+
+
+class Manifest(object):
+	"""
+	Small sidecar file (same name as the tweets file with the .manifest
+	extension) recording the number of tweets of a tweets file, along with the
+	size and modification time of the file when they were counted. The count
+	is only trusted while the size and the modification time of the file are
+	unchanged, so that counting tweets is a metadata read.
+	"""
+	extension = '.manifest'
+
+	def __init__(self, path=None):
+		"""
+		Parameters:
+		path - path of the tweets file, None to keep the manifest in memory.
+		"""
+		super(Manifest, self).__init__()
+		self.path = path + self.extension if path else None
+		self.size = None
+		self.mtime = None
+		self.count = None
+		self.dirty = False
+		self.load()
+
+	def load(self):
+		"""
+		Loads the manifest file if it exists.
+
+		Return value:
+		True if the manifest has been properly loaded, False otherwise.
+		"""
+		if not self.path or not os.path.isfile(self.path):
+			return False
+		try:
+			with open(self.path) as f:
+				d = json.load(f)
+			self.size, self.mtime, self.count = d['size'], d['mtime'], d['count']
+		except (IOError, ValueError, KeyError, TypeError), e:
+			logging.warning("Cannot read manifest %s: %s" % (self.path, e))
+			return False
+		return True
+
+	def get(self, st):
+		"""
+		Parameters:
+		st - result of os.stat on the tweets file
+
+		Return value:
+		The number of tweets if the manifest is up to date with the tweets file,
+		None otherwise.
+		"""
+		if st.st_size == 0:
+			return 0
+		if (st.st_size, st.st_mtime) == (self.size, self.mtime):
+			return self.count
+		return None
+
+	def set(self, st, count):
+		self.size, self.mtime, self.count = st.st_size, st.st_mtime, count
+		self.dirty = True
+
+	def save(self):
+		"""
+		Writes the manifest file if it has changed since it was loaded.
+		"""
+		if not self.path or not self.dirty:
+			return
+		try:
+			with open(self.path, 'w') as f:
+				json.dump({'size': self.size, 'mtime': self.mtime,
+						   'count': self.count}, f)
+			self.dirty = False
+		except (IOError, OSError), e:
+			logging.warning("Cannot write manifest %s: %s" % (self.path, e))
+
+class Segments(object):
+	"""
+	Tweets file written concurrently by several processes. Every writing
+	process appends to its own segment file, named after the path of the file,
+	the host and the process id (<path>.seg-<host>-<pid>), so that lines written
+	by different processes are never mixed. The segments are listed in a
+	manifest written next to the file (<path>.segments), and the file and its
+	segments are read as a single corpus: the tweets of the file, if it exists,
+	followed by those of every segment in the order of their names. compact
+	merges the segments into the file.
+	"""
+	mark = '.seg-'
+	extension = '.segments'
+
+	def __init__(self, path, decoder=None, fsync=None):
+		"""
+		Parameters:
+		path    - path of the tweets file
+		decoder - decoder of the tweets read (see decoder.Decoder)
+		fsync   - fsync policy of the segment written by this process (see
+				  Tweets)
+		"""
+		super(Segments, self).__init__()
+		self.path = path
+		self.decoder = decoder if decoder else Decoder()
+		self.fsync = fsync
+		self.files = {}		# path -> Tweets reading the file
+		self.writer = None	# Tweets writing the segment of this process
+
+	@classmethod
+	def find(cls, path):
+		"""
+		Return value:
+		The sorted list of the paths of the segments of the given path, read
+		from its manifest.
+		"""
+		manifest = path + cls.extension
+		if not os.path.isfile(manifest):
+			return []
+		directory = os.path.dirname(path)
+		with open(manifest) as f:
+			names = set(line.strip() for line in f if line.endswith('\n'))
+		return sorted(os.path.join(directory, n) for n in names)
+
+	@classmethod
+	def segment_path(cls, path):
+		"""
+		Return value:
+		The path of the segment of the current process.
+		"""
+		return "%s%s%s-%d" % (path, cls.mark, socket.gethostname(), os.getpid())
+
+	def parts(self):
+		"""
+		Return value:
+		The list of Tweets instances reading the file and its segments, up to
+		date with the segments created by other processes.
+		"""
+		paths = Segments.find(self.path)
+		if find(self.path):
+			paths.insert(0, find(self.path))
+		parts = []
+		for p in paths:
+			if p not in self.files:
+				self.files[p] = Tweets(p, 'r', concurrent=False)
+				self.files[p].decoder = self.decoder
+			parts.append(self.files[p])
+		return parts
+
+	def __len__(self):
+		return sum(len(t) for t in self.parts())
+
+	def __getitem__(self, i):
+		if i < 0:
+			i += len(self)
+		if i >= 0:
+			for t in self.parts():
+				n = len(t)
+				if i < n:
+					return t[i]
+				i -= n
+		raise IndexError("tweet index out of range")
+
+	def __iter__(self):
+		for t in self.parts():
+			for tw in t:
+				yield tw
+
+	def extend(self, lines):
+		"""
+		Appends JSON encoded tweets, each one ending with a newline, to the
+		segment of the current process.
+		"""
+		if self.writer is None:
+			segment = Segments.segment_path(self.path)
+			if segment not in Segments.find(self.path):
+				# a single small write to a file opened in append mode is not
+				# mixed with the writes of other processes
+				with open(self.path + Segments.extension, 'a') as f:
+					f.write(os.path.basename(segment) + '\n')
+			self.writer = Tweets(segment, 'a+', fsync=self.fsync,
+								 concurrent=False)
+		self.writer.pending.extend(lines)
+		self.writer.flush()
+
+	def close(self):
+		if self.writer is not None:
+			self.writer.close()
+			self.writer = None
+		for t in self.files.values():
+			t.close()
+		self.files = {}
+
+	@classmethod
+	def compact(cls, path):
+		"""
+		Appends the tweets of the segments of the given path to the file
+		itself, in the order in which they are read, and removes the
+		segments. It must not be run while processes are writing segments.
+
+		Return value:
+		The number of merged segments.
+		"""
+		segments = cls.find(path)
+		if not segments:
+			return 0
+		with open_file(find(path) or path, 'a') as out:
+			for seg in segments:
+				with open_file(seg, 'r') as f:
+					for line in f:
+						out.write(line if line.endswith('\n') else line + '\n')
+				out.flush()
+		os.remove(path + cls.extension)
+		for seg in segments:
+			for p in [seg] + [seg + ext for ext in Tweets.sidecar_extensions]:
+				if os.path.isfile(p):
+					os.remove(p)
+		return len(segments)
 
 class Tweets(object):
 	"""
 	Manages a list of tweets loaded from a file or a list.
 	Makes it possible to iterate over tweets using a unique structure when
 	tweets are in a Python list or stored on disk in a file.
+	Tweets can also be read from a slim corpus directory (see the slim module),
+	from a gzip/zstd/lz4 compressed file (see the compression module), the
+	compressed file of a path being used when the path itself does not exist,
+	or from the path <archive_dir>/<uid> of a user in an archive (see the
+	archive module).
+	Tweets stored on disk can also be accessed by position (tweets[i],
+	tweets[i:j], len(tweets)) through a line index built on first use, and
+	are counted using a manifest kept up to date by append.
+	Appended tweets can be buffered and written to disk in groups, in which
+	case the instance should be used as a context manager (or closed) so that
+	the last group is written:
+
+		with Tweets(path, buffer_size=500, flush_interval=10) as tweets:
+			for tw in stream:
+				tweets.append(tw)
 	"""
+	fsync_policies = (None, 'flush', 'close')
+	sidecar_extensions = (LineIndex.extension, Manifest.extension,
+						  Segments.extension)
 
-	def __init__(self, tw_in=None, mode='a+'):
+	def __init__(self, tw_in=None, mode='a+', buffer_size=1,
+				 flush_interval=None, fsync=None, fields=None, concurrent=None):
 		"""
 		Initializes an instance by loading file/list.
 
 		Parameters:
 		tw_in - Object from which the input tweets are read.
 		mode - Opening mode if tw_in is a file path, useless otherwise.
+		buffer_size - number of appended tweets kept in memory before they are
+					  written to the file, 1 writes every tweet immediately.
+		flush_interval - maximum number of seconds an appended tweet is kept in
+						 memory, checked when a tweet is appended. None to only
+						 rely on buffer_size.
+		fsync - None to let the OS write the file when it wants, 'flush' to
+				call fsync every time a group of tweets is written, 'close' to
+				call fsync only when the file is closed.
+		fields - dotted paths of the fields to keep when decoding tweets stored
+				 on disk (see decoder.Decoder), None to keep whole tweets.
+		concurrent - True if several processes append to the file, in which
+					 case every process appends to its own segment (see
+					 Segments), None to do so only if the file already has
+					 segments, False to ignore the segments.
 		"""
 		super(Tweets, self).__init__()
 		self.index = 0	# cursor pointing to the next tweet to return
+		# iterator over the tweets of the backends that are not lists
+		self.cursor = None
+		self.path = None
+		self.line_index = None
+		if fsync not in self.fsync_policies:
+			logging.error("fsync policy not supported. Is %s and should be one of %s." % (repr(fsync), repr(self.fsync_policies)))
+			fsync = None
+		self.buffer_size = max(1, buffer_size)
+		self.flush_interval = flush_interval
+		self.fsync = fsync
+		self.decoder = Decoder(fields)
+		self.concurrent = concurrent
+		self.pending = []	# encoded tweets waiting to be written
+		self.last_flush = time.time()
 		self._load(tw_in, mode)
+		self.manifest = Manifest(self.path)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.close()
+		return False
+
+	@classmethod
+	def is_sidecar(cls, path):
+		"""
+		Return value:
+		True if the given path is a file written by Tweets next to a tweets
+		file (line index, ...), False otherwise.
+		"""
+		return path.endswith(cls.sidecar_extensions)
+
+	@classmethod
+	def users_files(cls, users_dir, skip=('.extended',)):
+		"""
+		Lists the files of tweets of a users directory, named after the ids of
+		the users, possibly with the extension of their compression. The
+		files written by Tweets next to them (line indexes, manifests,
+		segments of concurrent appends and their sidecars) are skipped.
+
+		Parameters:
+		users_dir - the users directory
+		skip      - extensions of the other files of the directory that are
+					not tweets
+
+		Return value:
+		The sorted list of the pairs (uid, name) of the files of tweets.
+		"""
+		files = []
+		for name in os.listdir(users_dir):
+			if not os.path.isfile(os.path.join(users_dir, name)) \
+					or cls.is_sidecar(name) or name.endswith(tuple(skip)) \
+					or Segments.mark in name:
+				continue
+			uid = name
+			for ext in KNOWN_FORMATS:
+				if uid.endswith(ext):
+					uid = uid[:-len(ext)]
+			files.append((uid, name))
+		return sorted(files)
 
 	def _load(self, tw_in=None, mode='a+'):
 		"""
@@ -40,41 +533,112 @@ class Tweets(object):
 				  None: (lambda: [], False),
 				  list: (lambda: tw_in, False),
 				  file: (lambda: tw_in, True),
-				  str: 	(lambda: open(tw_in, mode), True)
+				  str: 	(lambda: open_file(find(tw_in) or tw_in, mode), True)
 				}
 		input_type = None if tw_in == None else type(tw_in)
+		if input_type == str and SlimCorpus.is_slim(tw_in):
+			self.tweets = SlimCorpus(tw_in)
+			self.lazy = False
+			return True
+		segmented = input_type == str and self.concurrent is not False \
+			and (self.concurrent or Segments.find(tw_in))
+		if segmented:
+			self.tweets = Segments(tw_in, self.decoder, self.fsync)
+			self.lazy = False
+			return True
+		located = locate(tw_in) if input_type == str else None
+		if located and not os.path.isfile(tw_in):
+			archive, uid = located
+			self.tweets = archive.user(uid, self.decoder)
+			self.lazy = False
+			return True
 		if input_type in cases.keys():
 			self.tweets = cases[input_type][0]()
 			self.lazy = cases[input_type][1]
+			if self.lazy and os.path.isfile(self.tweets.name):
+				self.path = self.tweets.name
 			return True
 		else:
 			logging.error("Tweets input mode not supported. Is %s and should be one of %s." % (type(tw_in), repr(cases.keys())))
 			return False
 
 	def __iter__(self):
+		"""
+		Restarts the iteration from the first tweet.
+		"""
+		self.flush()
+		if self.lazy:
+			self.tweets.seek(0)
+		else:
+			self.index = 0
+			self.cursor = None
 		return self
 
+	def __len__(self):
+		return self.size()
+
+	def __getitem__(self, i):
+		"""
+		Return value:
+		The i-th tweet if i is an integer, or a Tweets instance containing the
+		selected tweets if i is a slice. When the tweets are stored on disk,
+		only the selected lines are read and decoded.
+		"""
+		if isinstance(i, slice):
+			return Tweets([self[j] for j in range(*i.indices(len(self)))])
+		if not self.lazy:
+			self.flush()
+			return self.tweets[i]
+		offset = self._line_index()[i]
+		pos = self.tweets.tell()
+		try:
+			self.tweets.seek(offset)
+			line = self.tweets.readline()
+		finally:
+			self.tweets.seek(pos)
+		return self.decoder(line)
+
+	def _line_index(self):
+		"""
+		Return value:
+		The line index of the file storing the tweets, up to date with the
+		content of the file.
+		"""
+		self.flush()
+		if self.line_index is None:
+			self.line_index = LineIndex(self.tweets, self.path)
+		self.line_index.refresh()
+		return self.line_index
+
 	def next(self):
 		"""
 		Return value:
 		A dictionary object containing the informations of the next tweet to be
 		returned.
 		"""
+		if self.pending:
+			self.flush()
 		# case when tweets are stored on disk
 		if self.lazy:
 			line = self.tweets.readline()
 			if line:
-				data = json.loads(line.strip())
+				data = self.decoder(line)
 			else:
 				raise StopIteration
 		# case when tweets are stored in a Python list
-		else:
+		elif type(self.tweets) == list:
 			try:
 				data = self.tweets[self.index]
 			except IndexError:
 				index = 0
 				raise StopIteration
 			self.index += 1
+		# case when tweets are read from segments, an archive or a slim
+		# corpus, whose tweets are read in order instead of looked up
+		else:
+			if self.cursor is None:
+				self.cursor = iter(self.tweets)
+			data = next(self.cursor)
 		return data
 
 	def tolist(self):
@@ -87,11 +651,22 @@ class Tweets(object):
 		"""
 		if type(self.tweets) == list:
 			return self.tweets
+		elif not self.lazy:
+			self.flush()
+			return list(self.tweets)
 		else:
+			self.flush()
 			self.tweets.seek(0)
-			tweets_list = [json.loads(line.strip()) for line in self.tweets]
+			tweets_list = [self.decoder(line) for line in self.tweets]
 			return tweets_list
 
+	def query(self):
+		"""
+		Return value:
+		A lazy query over the tweets, see TweetsQuery.
+		"""
+		return TweetsQuery(self)
+
 	def filter(self, f=None):
 		"""
 		Filter the list of tweets using a given function.
@@ -100,15 +675,238 @@ class Tweets(object):
 		f - the filtering function
 
 		Return value:
-		A list containing the tweets for which the filtering function f returns
-		True.
+		A lazy query yielding the tweets for which the filtering function f
+		returns True.
 		"""
-		tweets = self.tolist()
-		if f is None:
-			return tweets
+		return self.query().filter(f)
+
+	def filter_on_hashtags(self, hashtags, action='remove'):
+		"""
+		See TweetsQuery.filter_on_hashtags.
+		"""
+		return self.query().filter_on_hashtags(hashtags, action)
+
+	def filter_on_text(self, words, action='remove'):
+		"""
+		See TweetsQuery.filter_on_text.
+		"""
+		return self.query().filter_on_text(words, action)
+
+	def split(self, n):
+		"""
+		Splits the file storing the tweets in at most n ranges of consecutive
+		lines of about the same size, so that they can be processed in
+		parallel (see read_range and parallel.map_ranges). Plain files are
+		split on newline-aligned byte offsets, compressed files on their line
+		index.
+
+		Return value:
+		The list of the pairs (start, end) of positions of the ranges, end
+		being None for the last range.
+		"""
+		if not self.lazy:
+			logging.error("Only tweets stored in a file can be split.")
+			return []
+		self.flush()
+		n = max(1, n)
+		if hasattr(self.tweets, 'line_offsets'):
+			index = self._line_index()
+			count = len(index)
+			bounds = sorted(set(index[count * k // n] for k in range(n)
+								if count * k // n < count)) or [0]
+		else:
+			pos = self.tweets.tell()
+			size = os.fstat(self.tweets.fileno()).st_size
+			bounds = [0]
+			for k in range(1, n):
+				self.tweets.seek(max(size * k // n - 1, 0))
+				self.tweets.readline()
+				bound = self.tweets.tell()
+				if bounds[-1] < bound < size:
+					bounds.append(bound)
+			self.tweets.seek(pos)
+		return zip(bounds, bounds[1:] + [None])
+
+	def read_range(self, start, end=None):
+		"""
+		Yields the tweets of the lines starting between the positions start
+		(included) and end (excluded) of the file, None reading until the end
+		of the file. The file is opened again so that ranges can be read
+		concurrently.
+		"""
+		self.flush()
+		with open_file(self.path, 'r') as f:
+			f.seek(start)
+			while end is None or f.tell() < end:
+				line = f.readline()
+				if not line:
+					break
+				yield self.decoder(line)
+
+	def _stat(self):
+		self.tweets.flush()
+		return os.fstat(self.tweets.fileno())
+
+	def size(self):
+		"""
+		Return value:
+		The number of tweets. When the tweets are stored on disk, the count is
+		read from the manifest if it is up to date, otherwise the lines are
+		counted using the line index without decoding them and the manifest is
+		updated.
+		"""
+		self.flush()
+		if not self.lazy:
+			return len(self.tweets)
+		st = self._stat()
+		count = self.manifest.get(st)
+		if count is None:
+			count = len(self._line_index())
+			self.manifest.set(st, count)
+			self.manifest.save()
+		return count
+
+	def append(self, tw):
+		"""
+		Appends a given tweet to the list of tweets. If the tweets are stored
+		in a file on disk, then the appended tweet is written at the end of the
+		file (or of the tweets of the user in the archive), once buffer_size
+		tweets are waiting to be written or flush_interval seconds have passed
+		since the last write.
+
+		Parameters:
+		tw - the tweet to append, either in a dictionary or as directly as a
+			 string when the lazy opening mode is on, any object when the lazy
+			 mode is off.
+
+		Return value:
+		True if the tweet has been properly appended, False otherwise.
+		"""
+		if self.lazy or isinstance(self.tweets, (UserTweets, Segments)):
+			cases = {
+					  dict: lambda: json.dumps(tw) + "\n",
+					  str: lambda: tw + "\n"
+					}
+			tw_type = type(tw)
+			if tw_type in cases.keys():
+				self.pending.append(cases[tw_type]())
+			else:
+				logging.error("Tweet type not supported. ")
+				return False
+			expired = self.flush_interval is not None \
+				and time.time() - self.last_flush >= self.flush_interval
+			if len(self.pending) >= self.buffer_size or expired:
+				self.flush()
+		elif type(self.tweets) == list:
+			self.tweets.append(tw)
+		else:
+			logging.error("Tweets loaded from a slim corpus are read-only.")
+			return False
+		return True
+
+	def column(self, name):
+		"""
+		Return value:
+		The values of the given field for every tweet. Columns of a slim corpus
+		are read directly from the corpus without rebuilding the tweets.
+		"""
+		if isinstance(self.tweets, SlimCorpus):
+			return self.tweets.column(name)
+		return [tw.get(name) for tw in self]
+
+	def flush(self):
+		"""
+		Writes the buffered tweets at the end of the file in a single write,
+		and calls fsync if the fsync policy is 'flush'. Tweets of a user in an
+		archive are written in a new extent of the archive, and tweets of a
+		file written concurrently in the segment of the process.
+		"""
+		self.last_flush = time.time()
+		if not self.pending:
+			return
+		if not self.lazy:
+			self.tweets.extend(self.pending)
+			self.pending = []
+			return
+		pos = self.tweets.tell()
+		# count known by the manifest before this write, if any
+		count = self.manifest.get(self._stat())
+		self.tweets.seek(0, os.SEEK_END)
+		self.tweets.write(''.join(self.pending))
+		self.tweets.flush()
+		if self.fsync == 'flush':
+			os.fsync(self.tweets.fileno())
+		if count is not None:
+			self.manifest.set(self._stat(), count + len(self.pending))
+		self.pending = []
+		self.tweets.seek(pos)
+
+	def close(self):
+		"""
+		Writes the buffered tweets, saves the manifest and closes the file
+		storing the tweets, if any.
+		"""
+		if self.lazy:
+			self.flush()
+			if self.fsync == 'close':
+				os.fsync(self.tweets.fileno())
+			self.manifest.save()
+			if self.line_index is not None:
+				self.line_index.close()
+			self.tweets.close()
 		else:
-			filtered = filter(f, tweets)
-		return Tweets(filtered)
+			self.flush()
+			if isinstance(self.tweets, Segments):
+				self.tweets.close()
+
+class TweetsQuery(object):
+	"""
+	Lazy and chainable query over a Tweets instance. Filters are only recorded
+	when they are added, and are all applied in one streaming pass when a
+	terminal operation (iteration, count, tolist) is run: each tweet is read
+	and decoded once and no intermediate list is built.
+	After a complete pass, counts holds the number of tweets read followed by
+	the number of tweets kept after each filter.
+	"""
+
+	def __init__(self, tweets, filters=None):
+		"""
+		Parameters:
+		tweets  - the Tweets instance (or any iterable of tweets) to query
+		filters - list of filtering functions already applied
+		"""
+		super(TweetsQuery, self).__init__()
+		self.tweets = tweets
+		self.filters = filters if filters else []
+		self.counts = []
+
+	def __iter__(self):
+		counts = [0] * (len(self.filters) + 1)
+		self.counts = counts
+		for tw in self.tweets:
+			counts[0] += 1
+			kept = True
+			for i, f in enumerate(self.filters):
+				if not f(tw):
+					kept = False
+					break
+				counts[i + 1] += 1
+			if kept:
+				yield tw
+
+	def filter(self, f=None):
+		"""
+		Adds a filtering function to the query.
+
+		Parameters:
+		f - the filtering function
+
+		Return value:
+		A new query keeping the tweets for which f returns True.
+		"""
+		if f is None:
+			return self
+		return TweetsQuery(self.tweets, self.filters + [f])
 
 	def filter_on_hashtags(self, hashtags, action='remove'):
 		"""
@@ -122,7 +920,7 @@ class Tweets(object):
 		action   - must be either 'keep' or 'remove'
 
 		Return value:
-		The filtered list of tweets.
+		The filtered query.
 		"""
 		if action == 'remove':
 			wrap = lambda x: not(x)
@@ -147,7 +945,7 @@ class Tweets(object):
 		action - must be either 'keep' or 'remove'
 
 		Return value:
-		The filtered list of tweets.
+		The filtered query.
 		"""
 		if action == 'remove':
 			wrap = lambda x: not(x)
@@ -155,42 +953,175 @@ class Tweets(object):
 			wrap = lambda x: x
 		else:
 			return self
-		f = lambda tw: words & wrap(set(w.lower() for w in tw['text'].split()))
+		f = lambda tw: wrap(words & set(w.lower() for w in tw['text'].split()))
 		return self.filter(f)
 
+	def count(self):
+		"""
+		Return value:
+		The number of tweets matching the query.
+		"""
+		return sum(1 for tw in self)
+
 	def size(self):
-		return len(self.tolist())
+		return self.count()
 
-	def append(self, tw):
+	def tolist(self):
 		"""
-		Appends a given tweet to the list of tweets. If the tweets are stored
-		in a file on disk, then the appended tweet is written at the end of the
-		file.
+		Return value:
+		A list containing the tweets matching the query.
+		"""
+		return list(self)
 
+class Vocabulary(object):
+	"""
+	Set of terms in which every term is interned (stored once, and returned as
+	the same object by every lookup) and associated to an integer id given in
+	the order of insertion. Membership tests cost one hash lookup, and term
+	ids can be used as list indexes instead of hashing the terms again.
+	"""
+	def __init__(self, terms=None):
+		"""
 		Parameters:
-		tw - the tweet to append, either in a dictionary or as directly as a
-			 string when the lazy opening mode is on, any object when the lazy
-			 mode is off.
+		terms - iterable of the terms to add to the vocabulary
+		"""
+		super(Vocabulary, self).__init__()
+		self.ids = {}	# term -> id
+		self.terms = []	# id -> term
+		if terms:
+			self.update(terms)
+
+	def __contains__(self, term):
+		return term in self.ids
+
+	def __len__(self):
+		return len(self.terms)
+
+	def __iter__(self):
+		return iter(self.terms)
+
+	def __getitem__(self, term_id):
+		return self.terms[term_id]
+
+	def add(self, term):
+		"""
+		Adds a term to the vocabulary if it is not already in it.
 
 		Return value:
-		True if the tweet has been properly appended, False otherwise.
+		The id of the term.
 		"""
-		if self.lazy:
-			self.tweets.seek(0, os.SEEK_END)
-			cases = {
-					  dict: lambda: self.tweets.write(json.dumps(tw) + "\n"),
-					  str: lambda: self.tweets.write(tw + "\n")
-					}
-			tw_type = type(tw)
-			if tw_type in cases.keys():
-				cases[tw_type]()
-				self.tweets.flush()
-			else:
-				logging.error("Tweet type not supported. ")
-				return False
-		else:
-			self.tweets.append(tw)
-		return True
+		term_id = self.ids.get(term)
+		if term_id is None:
+			if type(term) == str:
+				term = intern(term)
+			term_id = len(self.terms)
+			self.ids[term] = term_id
+			self.terms.append(term)
+		return term_id
+
+	def update(self, terms):
+		for term in terms:
+			self.add(term)
+
+	def get(self, term, default=None):
+		"""
+		Return value:
+		The id of the given term, default if it is not in the vocabulary.
+		"""
+		return self.ids.get(term, default)
+
+	def intern(self, term):
+		"""
+		Return value:
+		The instance of the given term stored in the vocabulary, after adding
+		the term if needed.
+		"""
+		return self.terms[self.add(term)]
+
+	def encode(self, terms):
+		"""
+		Return value:
+		The list of the ids of the given terms, which are added to the
+		vocabulary if needed.
+		"""
+		add = self.add
+		return [add(t) for t in terms]
+
+	def decode(self, term_ids):
+		"""
+		Return value:
+		The list of the terms of the given ids.
+		"""
+		terms = self.terms
+		return [terms[i] for i in term_ids]
+
+	def tolist(self):
+		return list(self.terms)
+
+class LRUCache(object):
+	"""
+	Dictionary bounded to a maximum number of items, the least recently used
+	item being removed when an item is added to a full cache. The numbers of
+	successful and failed lookups are counted.
+	"""
+	def __init__(self, max_size=100000):
+		"""
+		Parameters:
+		max_size - maximum number of items of the cache
+		"""
+		super(LRUCache, self).__init__()
+		self.max_size = max(1, max_size)
+		self.items = OrderedDict()	# from the least to the most recently used
+		self.hits = 0
+		self.misses = 0
+
+	def __contains__(self, key):
+		return key in self.items
+
+	def __len__(self):
+		return len(self.items)
+
+	def get(self, key, default=None):
+		"""
+		Return value:
+		The item of the given key, which becomes the most recently used one,
+		default if the key is not in the cache.
+		"""
+		try:
+			value = self.items.pop(key)
+		except KeyError:
+			self.misses += 1
+			return default
+		self.items[key] = value
+		self.hits += 1
+		return value
+
+	def put(self, key, value):
+		"""
+		Adds an item to the cache, removing the least recently used item if
+		the cache is full.
+		"""
+		self.items.pop(key, None)
+		self.items[key] = value
+		if len(self.items) > self.max_size:
+			self.items.popitem(last=False)
+
+	def clear(self):
+		self.items.clear()
+		self.hits = 0
+		self.misses = 0
+
+	def stats(self):
+		"""
+		Return value:
+		A dictionary containing the numbers of hits, misses and items of the
+		cache and its hit rate.
+		"""
+		lookups = self.hits + self.misses
+		return {'hits': self.hits,
+				'misses': self.misses,
+				'size': len(self.items),
+				'hit_rate': float(self.hits) / lookups if lookups else 0.}
 
 class TSV(object):
 	"""
@@ -203,16 +1134,22 @@ class TSV(object):
 	can have many elements. This data structure gives access to two dictionaries:
 		- keys: store the belonging elements for every category
 		- values: store the associated category for every elements
+	Elements and categories are interned in a Vocabulary, which can be shared
+	with other structures, and elements holds the vocabulary of the elements.
 	"""
-	def __init__(self, tsv_file):
+	def __init__(self, tsv_file, vocabulary=None):
 		"""
 		Parameters:
-		tsv_file - the TSV file to load
+		tsv_file   - the TSV file to load
+		vocabulary - Vocabulary in which the strings are interned, a new one
+					 by default
 		"""
 		super(TSV, self).__init__()
 		self.tsv_file = tsv_file
+		self.vocabulary = vocabulary if vocabulary is not None else Vocabulary()
 		self.keys = defaultdict(list)
 		self.values = {}
+		self.elements = Vocabulary()
 		self.load()
 
 	def load(self):
@@ -240,8 +1177,10 @@ class TSV(object):
 			linecount += 1
 			fields = re.split("\s+", line.strip())
 			if len(fields) > 1:
-				self.keys[fields[0]].append(fields[1])
-				self.values[fields[1]] = fields[0]
+				category, element = map(self.vocabulary.intern, fields[:2])
+				self.keys[category].append(element)
+				self.values[element] = category
+				self.elements.add(element)
 			else:
 				logging.warning("Only %d field(s) on line %d of the TSV file." % (len(fields), linecount))
 		return True
@@ -249,17 +1188,21 @@ class TSV(object):
 class LSF(object):
 	"""
 	Tool to load a Line-Separated File. This kind of file contains a list of
-	words, one word on each line.
+	words, one word on each line. The words are kept in order in a list and
+	interned in a Vocabulary for membership tests.
 	"""
-	def __init__(self, input_file):
+	def __init__(self, input_file, vocabulary=None):
 		"""
 		Initializes the LSF instance by loading the input file.
 
 		Parameters:
 		input_file - file to read to store its content in memory
+		vocabulary - Vocabulary in which the words are interned, a new one by
+					 default
 		"""
 		super(LSF, self).__init__()
 		self.input_file = input_file
+		self.vocabulary = vocabulary if vocabulary is not None else Vocabulary()
 		self.words = []
 		self.load()
 
@@ -284,8 +1227,21 @@ class LSF(object):
 			return False
 
 		for line in input_file:
-			self.words.append(line.strip())
+			self.words.append(self.vocabulary.intern(line.strip()))
 		return True
 
+	def __contains__(self, word):
+		return word in self.vocabulary
+
+	def __len__(self):
+		return len(self.words)
+
 	def tolist(self):
 		return self.words
+
+	def tovocabulary(self):
+		"""
+		Return value:
+		A Vocabulary containing the words of the file only.
+		"""
+		return Vocabulary(self.words)
@@ -0,0 +1,113 @@
+''' Decoding of JSON tweets using the fastest JSON library available (orjson,
+then ujson, then the standard json module), with an optional projection that
+only keeps the requested fields of every decoded object.
+
+Fields are given as dotted paths, e.g. 'entities.hashtags' only keeps the
+hashtags of the entities. The projected objects do not hold any reference to
+the rest of the decoded object, which is freed right after decoding.
+'''
+
+import json
+
+BACKENDS = {'json': json.loads}
+try:
+    import orjson
+    BACKENDS['orjson'] = orjson.loads
+except ImportError:
+    pass
+try:
+    import ujson
+    BACKENDS['ujson'] = lambda s: ujson.loads(s, precise_float=True)
+except ImportError:
+    pass
+DEFAULT_BACKEND = [b for b in ('orjson', 'ujson', 'json') if b in BACKENDS][0]
+
+
+class Decoder(object):
+    """
+    >>> line = ('{"id": 1, "text": "hi #run", "place": null, "lang": "en",'
+    ...         ' "entities": {"hashtags": [{"text": "run", "indices": [3, 7]}],'
+    ...         ' "urls": []}, "user": {"id": 2, "lang": "en"}}\\n')
+    >>> d = Decoder(['text', 'entities.hashtags', 'user.lang', 'place', 'geo'])
+    >>> tw = d(line)
+    >>> sorted(tw.keys())
+    ['entities', 'place', 'text', 'user']
+    >>> tw['entities'] == {'hashtags': [{'text': 'run', 'indices': [3, 7]}]}
+    True
+    >>> tw['user'] == {'lang': 'en'}
+    True
+    >>> Decoder(['user', 'user.lang'])(line)['user'] == {'id': 2, 'lang': 'en'}
+    True
+    >>> Decoder()(line) == json.loads(line)
+    True
+
+    Every backend decodes the projected fields to identical dictionaries:
+    >>> fields = ['id', 'text', 'entities', 'user', 'place']
+    >>> all(Decoder(fields, b)(line) == Decoder(fields, 'json')(line)
+    ...     for b in BACKENDS)
+    True
+    """
+
+    def __init__(self, fields=None, backend=None):
+        """
+        Parameters:
+        fields  - list of the dotted paths of the fields to keep, None to keep
+                  the whole objects.
+        backend - name of the JSON library to use amongst BACKENDS, the
+                  fastest one by default.
+        """
+        super(Decoder, self).__init__()
+        if backend is None:
+            backend = DEFAULT_BACKEND
+        elif backend not in BACKENDS:
+            raise Exception("JSON backend %s not available: must be amongst %s"
+                            % (backend, repr(BACKENDS.keys())))
+        self.backend = backend
+        self.loads = BACKENDS[backend]
+        self.fields = fields
+        self.projection = self.compile(fields) if fields else None
+
+    @staticmethod
+    def compile(fields):
+        """
+        Builds the tree of the fields to keep: every key maps to the tree of
+        its subfields to keep, or to None to keep the whole value.
+        """
+        tree = {}
+        for f in sorted(fields, key=lambda x: x.count('.')):
+            node = tree
+            keys = f.split('.')
+            for k in keys[:-1]:
+                if k in node and node[k] is None:
+                    break  # the whole parent value is already kept
+                node = node.setdefault(k, {})
+            else:
+                node[keys[-1]] = None
+        return tree
+
+    def project(self, obj, tree):
+        projected = {}
+        for k, subtree in tree.iteritems():
+            if k not in obj:
+                continue
+            v = obj[k]
+            if subtree is not None and isinstance(v, dict):
+                v = self.project(v, subtree)
+            projected[k] = v
+        return projected
+
+    def __call__(self, line):
+        """
+        Return value:
+        The object decoded from the given JSON line, projected on the fields
+        of the decoder.
+        """
+        obj = self.loads(line.strip())
+        if self.projection is None:
+            return obj
+        return self.project(obj, self.projection)
+
+
+if (__name__ == '__main__'):
+    import doctest
+    doctest.testmod()
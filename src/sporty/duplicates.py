@@ -0,0 +1,121 @@
+''' Detection of the near-duplicate texts of a corpus.
+
+Templated tweets, e.g. the workout summaries posted by sport trackers or the
+check-ins of "I'm at ...", only differ by their numbers and urls. The words
+of a text (e.g. the cleaned text or the features of a tweet), whose numbers
+are replaced by 0, are summarized by a MinHash signature, the fraction of
+the values shared by the signatures of two texts estimating the Jaccard
+similarity of their words. Texts sharing a band of their signatures
+(locality-sensitive hashing) are compared, so that a text is only compared
+to the texts likely to be similar to it.
+
+    >>> nd = NearDuplicates(threshold=0.9)
+    >>> texts = [u"just ran 5.2 km with nike", u"good morning",
+    ...          u"just ran 10.3 km with nike", u"im at gym", u"",
+    ...          u"im at gym", u""]
+    >>> representatives, assignment = nd.collapse(map(nd.words, texts))
+    >>> representatives
+    [0, 1, 3, 4, 6]
+    >>> assignment.tolist()
+    [0, 1, 0, 2, 3, 2, 4]
+'''
+
+import numpy as np
+import re
+from sklearn.utils import murmurhash3_32
+
+# prime greater than the hashes of the words
+PRIME = (1 << 32) + 15
+
+
+class NearDuplicates(object):
+    """
+    Groups the texts whose words are similar, every group being represented
+    by its first text.
+    """
+    number_regex = re.compile(r'\d+')
+
+    def __init__(self, threshold=0.9, num_perm=64, bands=16, seed=0):
+        """
+        Parameters:
+        threshold - estimated Jaccard similarity of the words of two texts
+                    from which the texts are near-duplicates
+        num_perm  - number of values of the signatures
+        bands     - number of bands of the signatures, two texts being only
+                    compared if all the values of one of their bands are equal
+        seed      - seed of the random permutations of the hashes
+        """
+        super(NearDuplicates, self).__init__()
+        if num_perm % bands:
+            raise Exception("The number of bands must divide the number of "
+                            "values of the signatures.")
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        rand = np.random.RandomState(seed)
+        # a * h + b cannot overflow for hashes h lower than 2^32
+        self.a = rand.randint(1, 1 << 31, num_perm).astype(np.uint64)
+        self.b = rand.randint(0, 1 << 31, num_perm).astype(np.uint64)
+
+    def words(self, text):
+        """
+        Return value:
+        The set of the words of a text separated by spaces, lowercased, with
+        their numbers replaced by 0.
+        """
+        return set(self.number_regex.sub('0', w) for w in text.lower().split())
+
+    def signature(self, words):
+        """
+        Return value:
+        The MinHash signature of a non-empty set of words.
+        """
+        hashes = np.array([murmurhash3_32(w.encode('utf-8')
+                                          if isinstance(w, unicode) else w,
+                                          positive=True) for w in words],
+                          dtype=np.uint64)
+        return ((np.outer(self.a, hashes) + self.b[:, None])
+                % PRIME).min(axis=1)
+
+    def collapse(self, words_sets):
+        """
+        Groups the near-duplicates of a list of texts given as sets of words
+        (see words). A text joins the group of the first representative
+        near-duplicate of it, or becomes the representative of a new group.
+        Texts without words are never grouped.
+
+        Return value:
+        The pair (representatives, assignment): representatives is the list
+        of the indices of the representatives of the groups in the order of
+        the texts, and assignment the array of the numbers of the groups of
+        the texts, np.bincount(assignment) giving the sizes of the groups.
+        """
+        representatives = []
+        signatures = []     # signature of every group
+        buckets = [{} for i in xrange(self.bands)]
+        assignment = np.empty(len(words_sets), dtype=np.int64)
+        rows = self.rows
+        for i, words in enumerate(words_sets):
+            group = None
+            if words:
+                signature = self.signature(words)
+                keys = [signature[j * rows:(j + 1) * rows].tostring()
+                        for j in xrange(self.bands)]
+                for bucket, key in zip(buckets, keys):
+                    for g in bucket.get(key, ()):
+                        if np.mean(signatures[g] == signature) \
+                           >= self.threshold:
+                            group = g
+                            break
+                    if group is not None:
+                        break
+            if group is None:
+                group = len(representatives)
+                representatives.append(i)
+                signatures.append(signature if words else None)
+                if words:
+                    for bucket, key in zip(buckets, keys):
+                        bucket.setdefault(key, []).append(group)
+            assignment[i] = group
+        return representatives, assignment
@@ -4,8 +4,11 @@ http://homepage.psy.utexas.edu/homepage/faculty/pennebaker/reprints/LIWC2001.pdf
 '''
 
 from collections import defaultdict
+from datastructures import Vocabulary
 import os
 
+MEMO_SIZE = 100000
+
 
 class Lexicon(object):
     """
@@ -27,10 +30,32 @@ class Lexicon(object):
     [[]]
     >>> d.categories_for_tokens(['hithere'])
     [[u'Greet']]
+
+    The prefix patterns are stored in a trie, every prefix of a word shorter
+    than the word being matched, from the longest to the shortest (after the
+    empty prefix of a '*' pattern):
+
+    >>> tf = tempfile.NamedTemporaryFile()
+    >>> tf.write("%\\n1\\tA\\n2\\tB\\n3\\tC\\n%\\nhi*\\t01\\nhit*\\t02\\nhith*\\t03")
+    >>> tf.flush()
+    >>> d = Lexicon(tf.name)
+    >>> d.categories_for_tokens(['hithere', 'hit', 'hi', 'h', ''])
+    [[u'C', u'B', u'A'], [u'A'], [], [], []]
     """
 
-    def __init__(self, dict_file=None):
+    def __init__(self, dict_file=None, vocabulary=None, memo_size=MEMO_SIZE):
+        """
+        Parameters:
+        dict_file  - path of the LIWC dictionary
+        vocabulary - Vocabulary of the tokens, possibly shared with a Cleaner
+        memo_size  - number of tokens whose categories are kept in memory,
+                     the memo being emptied when it is full
+        """
         self.dict_file = dict_file
+        # vocabulary of the tokens, possibly shared with a Cleaner
+        self.vocabulary = vocabulary if vocabulary is not None else Vocabulary()
+        self.memo_size = memo_size
+        self.token_categories = {}  # token -> categories of the token
         self.load_dictionary(dict_file)
 
     def parse_categories(self, catText):
@@ -53,7 +78,15 @@ class Lexicon(object):
                 if '*' in exp:
                     self.prefix_patterns[exp[:-1]] = ids
                 else:
-                    self.exact_patterns[exp] = ids
+                    self.exact_patterns[self.vocabulary.intern(exp)] = ids
+        # trie of the prefix patterns, the categories of a pattern being
+        # stored under the key '' of the node of its last character
+        self.prefix_trie = {}
+        for prefix, ids in self.prefix_patterns.iteritems():
+            node = self.prefix_trie
+            for c in prefix:
+                node = node.setdefault(c, {})
+            node[''] = [self.categories[c] for c in ids]
 
     def load_dictionary(self, dict_file):
         dict_text = open(dict_file).read()
@@ -62,14 +95,37 @@ class Lexicon(object):
         self.parse_patterns(as_list[2])
 
     def categories_for_token(self, word):
-        result = []
+        """ Returns the categories of a token. They are only computed once
+        for every token kept in the memo. """
+        categories = self.token_categories.get(word)
+        if categories is None:
+            categories = self.match(word)
+            if len(self.token_categories) >= self.memo_size:
+                self.token_categories.clear()
+            self.token_categories[word] = categories
+        return categories
+
+    def match(self, word):
+        """ Returns the categories of the patterns matching a token: its exact
+        pattern if any, the patterns of its prefixes otherwise. The prefixes
+        are found by walking the trie along the token. """
         if word in self.exact_patterns:
-            result.extend(self.exact_patterns[word])
-        else:
-            for i in range(0, len(word)):
-                if word[:-i] in self.prefix_patterns:
-                    result.extend(self.prefix_patterns[word[:-i]])
-        return [self.categories[c] for c in result]
+            return [self.categories[c] for c in self.exact_patterns[word]]
+        categories = []
+        if word:
+            node = self.prefix_trie
+            # the empty prefix first, then the longest prefixes first
+            matches = []
+            for c in word[:-1]:
+                node = node.get(c)
+                if node is None:
+                    break
+                if '' in node:
+                    matches.append(node[''])
+            categories.extend(self.prefix_trie.get('', ()))
+            for m in reversed(matches):
+                categories.extend(m)
+        return categories
 
     def categories_for_tokens(self, tokens):
         """ Returns a list of lists. For each token, create a list of categories
@@ -9,6 +9,7 @@ import multiprocessing
 import numpy as np
 import os.path
 import re
+import scipy.sparse as sp
 import StringIO
 import sys
 import utils as utils
@@ -18,6 +19,7 @@ from sklearn import cross_validation
 from sklearn import metrics
 from sklearn import preprocessing
 from sklearn import svm
+from sklearn.base import BaseEstimator, TransformerMixin
 from sklearn.cross_validation import StratifiedKFold
 from sklearn.feature_extraction import DictVectorizer
 from sklearn.feature_extraction.text import TfidfTransformer
@@ -29,6 +31,35 @@ from tweets import Tweets
 logger = logging.getLogger(__name__)
 
 
+class MinDF(BaseEstimator, TransformerMixin):
+	"""
+	Removes the columns of a sparse matrix of features that are set in less
+	than min_df rows, as the option min_df of the scikit-learn vectorizers
+	does for matrices of hashed features.
+	"""
+	def __init__(self, min_df=1):
+		"""
+		Parameters:
+		min_df - minimum number of rows, or proportion of the rows if it is a
+				 float, in which a column is set to be kept
+		"""
+		self.min_df = min_df
+
+	def fit(self, X, y=None):
+		X = sp.csr_matrix(X)
+		min_df = self.min_df
+		if isinstance(min_df, float):
+			min_df = min_df * X.shape[0]
+		df = np.bincount(X.indices, minlength=X.shape[1])
+		self.mask_ = sp.diags((df >= min_df).astype(X.dtype), 0)
+		return self
+
+	def transform(self, X):
+		X = sp.csr_matrix(X) * self.mask_
+		X.eliminate_zeros()
+		return X
+
+
 class api(object):
 	"""
 	Programming interface dedicated to the study of the users' mood.
@@ -53,6 +84,19 @@ class api(object):
 		self.labels = []
 		self.tfidf_options = {}
 		self.X = None
+		# cache of the features of the tweets, see cache.FeaturesCache
+		self.features_cache = None
+		# names of the selected columns when the features are hashed
+		self.hashed_names = None
+		# names of the columns of the hashed features of the last corpus
+		self.features_names = None
+		# timing of the stages of buildX, see profiling.Profiler
+		self.profiler = None
+		# cleaned texts shared by the calls to buildX, see utils.Cleaner
+		self.cleaner_memo = None
+		# near-duplicate tweets of a user scored once by classifyUser, see
+		# duplicates.NearDuplicates
+		self.near_duplicates = None
 		if not clf:
 			self.clf = svm.SVC(kernel='linear', C=1, class_weight='auto')
 
@@ -108,16 +152,40 @@ class api(object):
 			fb_options = self.fb_options
 			fb_options['keep_rt'] = False
 			fb_options['labels'] = False
+			# the corpora to predict, e.g. the timelines of classifyUser,
+			# are read as they are extracted instead of by a process pool
+			fb_options['workers'] = 1
 			tfidf_options = self.tfidf_options
 		else:
 			self.cleaner_options = cleaner_options
 			self.fb_options = fb_options
 			self.tfidf_options = tfidf_options
 
+		# the stages are only timed when there is a profiler
+		if self.profiler:
+			timed = self.profiler.timed
+		else:
+			timed = lambda stage, f: f
+
 		# build the cleaner and the features
-		cl = utils.Cleaner(**cleaner_options)
+		cl = utils.Cleaner(memo=self.cleaner_memo, **cleaner_options)
 		fb = utils.FeaturesBuilder(corpus, cleaner=cl, **fb_options)
-		self.features, self.labels, self.twids = fb.run()
+		if self.profiler:
+			fb.profile(self.profiler)
+		if self.features_cache and not fb.hasher:
+			self.features, self.labels, self.twids = \
+				timed('builder.run', self.features_cache.run)(fb,
+															  cleaner_options)
+			logger.debug("features cache: %d hits, %d misses"
+						 % (self.features_cache.hits,
+							self.features_cache.misses))
+		else:
+			self.features, self.labels, self.twids = timed('builder.run',
+														   fb.run)()
+		self.features_names = fb.names
+		if self.cleaner_memo is not None:
+			logger.debug("cleaner memo: %d hits, %d misses"
+						 % (self.cleaner_memo.hits, self.cleaner_memo.misses))
 
 		# process labels so they are in the right format
 		self.vect_labels = []
@@ -129,18 +197,59 @@ class api(object):
 
 		if not predict:
 			# build the pipeline with the vectorizer and features selection
-			self.vectorizer = TfidfVectorizer(**tfidf_options)
 			self.features_selection = SelectKBest(chi2, k)
-			self.pipeline = Pipeline([('tfidf', self.vectorizer),
-									  ('chi2', self.features_selection)])
-			self.X = self.pipeline.fit_transform(self.features,
-												 self.vect_labels)
+			if fb.hasher:
+				# the features are already in a matrix
+				self.vectorizer = TfidfTransformer()
+				steps = [('min_df', MinDF(tfidf_options.get('min_df', 1))),
+						 ('tfidf', self.vectorizer)]
+			else:
+				self.vectorizer = TfidfVectorizer(**tfidf_options)
+				steps = [('tfidf', self.vectorizer)]
+			self.pipeline = Pipeline(steps + [('chi2', self.features_selection)])
+			self.X = timed('pipeline.fit_transform',
+						   self.pipeline.fit_transform)(self.features,
+														self.vect_labels)
+			self.hashed_names = None
+			if fb.hasher:
+				# only the names of the selected features are kept
+				self.hashed_names = dict(
+					(c, fb.names.get(c, str(c)))
+					for c in self.features_selection.get_support(True))
 		else:
 			# the pipeline has already been built in a previous call
-			self.X = self.pipeline.transform(self.features)
-		self.X = preprocessing.scale(self.X.toarray())
+			self.X = timed('pipeline.transform',
+						   self.pipeline.transform)(self.features)
+		X = self.X.toarray()
+		if not predict:
+			# statistics of the training features, with which scoreStream
+			# scales the tweets whatever the size of their batch
+			self.scaler = preprocessing.StandardScaler().fit(X)
+		self.X = timed('pipeline.scale', preprocessing.scale)(X)
 		return self.X
 
+	def feature_name(self, column):
+		"""
+		Return value:
+		The name of a column of the features matrix given to the features
+		selection.
+		"""
+		if self.hashed_names is not None:
+			return self.hashed_names.get(column, str(column))
+		return self.vectorizer.get_feature_names()[column]
+
+	def feature_columns(self, idx):
+		"""
+		Return value:
+		The list of the columns of the features of the idx-th tweet in the
+		features matrix given to the features selection.
+		"""
+		if self.hashed_names is not None:
+			return list(self.features[idx].indices)
+		names = self.vectorizer.get_feature_names()
+		return [names.index(ft) for ft in self.features[idx].split()
+				if ft in names]
+
 	def train(self):
 		"""
 		Trains the classifier.
@@ -208,7 +317,7 @@ class api(object):
 		A dictionary containing the benchmark statistics.
 		"""
 		label_names = self.labels[0].keys()
-		corpus = self.corpus.tolist()
+		corpus = self.corpus
 
 		print "#### Mood Benchmark ####"
 		print "Classifier: %s" % self.clf
@@ -290,8 +399,7 @@ class api(object):
 				print
 				print "--- %d Misclassified Tweets ---" % n_examples
 
-			def get_ft_attr(ft):
-				vect_idx = self.vectorizer.get_feature_names().index(ft)
+			def get_ft_attr(vect_idx):
 				coef_array = self.features_selection.get_support(True)
 				coef_indexes = np.where(coef_array == vect_idx)
 				if coef_indexes[0].size:
@@ -302,7 +410,7 @@ class api(object):
 					w = self.clf.coef_[0][coef_idx]
 				else:
 					w = 0
-				return vect_idx, w
+				return w
 
 			for j in range(min(n_examples, len(wrong_class))):
 				idx = wrong_class.pop()
@@ -313,17 +421,16 @@ class api(object):
 				if hascoef:
 					ft_idx = []
 					ft_w = []
-					for ft in self.features[idx].split():
-						if ft in self.vectorizer.get_feature_names():
-							vect_idx, w = get_ft_attr(ft)
-							if w != 0:
-								ft_idx.append(vect_idx)
-								ft_w.append(w)
+					for vect_idx in self.feature_columns(idx):
+						w = get_ft_attr(vect_idx)
+						if w != 0:
+							ft_idx.append(vect_idx)
+							ft_w.append(w)
 					sorted_w_idx = np.argsort(ft_w)
 					for k in sorted_w_idx:
 						left = 30
 						right = 20
-						ft = self.vectorizer.get_feature_names()[ft_idx[k]]
+						ft = self.feature_name(ft_idx[k])
 						ft = ft.encode('ascii', 'ignore')
 						w = ft_w[k]
 						print ("\t" + ft + ": ").ljust(left) \
@@ -336,7 +443,7 @@ class api(object):
 				if hascoef:
 					top_features_mean = reduce(np.add, scores['weight'])/n_folds
 					print "--- Top 50 features [over %d]: ---" % len(top_features_mean)
-					feature_names = [self.vectorizer.get_feature_names()[x]
+					feature_names = [self.feature_name(x)
 									 for x in
 									 self.features_selection.get_support(True)]
 					top50 = np.argsort(top_features_mean)[-50:]
@@ -360,7 +467,7 @@ class api(object):
 
 	def _classifyUser_onethread(self, forbid, auto_hash, requested, sporty,
 				    classifiers, users_dir, uids, label_names,
-				    probability, i, stdout_lock, raw=False):
+				    probability, i, stdout_lock, raw=False, profiles=None):
 		def print_results(t):
 			stdout_lock.acquire()
 			uid = t[0]
@@ -372,6 +479,21 @@ class api(object):
 			sys.stdout.flush()
 			stdout_lock.release()
 
+		if self.profiler:
+			# durations inherited from the parent process, already counted
+			self.profiler.drain()
+		try:
+			self._classifyUsers(forbid, auto_hash, requested, sporty,
+								classifiers, users_dir, uids, label_names,
+								probability, i, print_results, raw)
+		finally:
+			# durations of the stages sent back to the parent process
+			if profiles is not None:
+				profiles.put(self.profiler.drain() if self.profiler else {})
+
+	def _classifyUsers(self, forbid, auto_hash, requested, sporty,
+					   classifiers, users_dir, uids, label_names, probability,
+					   i, print_results, raw):
 		while True:
 			uid = uids.get()
 			if uid is None:
@@ -380,21 +502,25 @@ class api(object):
 			logger.debug("%d - Processing %s" % (i, uid))
 			utweets = Tweets(os.path.join(users_dir, str(uid)))
 
-			# removing sport tracker tweets
-			no_sport_utweets = utweets.filter_on_hashtags(forbid, 'remove')
-			if no_sport_utweets.size() < utweets.size(): 
+			# removing sport tracker tweets and tweets generated by well-known
+			# apps, the timeline being read once
+			filtered_utweets = utweets.query()\
+				.filter_on_hashtags(forbid, 'remove')\
+				.filter_on_hashtags(auto_hash, 'remove')
+			poms_query = filtered_utweets
+			if requested:
+				poms_query = filtered_utweets.filter_on_text(requested, 'keep')
+			poms_tweets = list(poms_query)
+
+			# counts: all tweets, without sporty tweets, without app tweets,
+			# known once the timeline is read, before the features are built
+			counts = poms_query.counts
+			if counts[1] < counts[0]:
 				# some sporty tweets have been removed
 				if not sporty:  # user is not supposed to be exercising
 					logger.info("no_sport user %s is exercising" % uid)
 					continue
-
-			# removing tweets generated by well-known apps
-			filtered_utweets = no_sport_utweets.filter_on_hashtags(auto_hash, 'remove')
-			score_denom = filtered_utweets.size()
-
-			poms_tweets = filtered_utweets.tolist()
-			if requested:
-				poms_tweets = filtered_utweets.filter_on_text(requested, 'keep').tolist()
+			score_denom = counts[2]
 
 			if not poms_tweets:
 				logger.info("no tweets for %s" % uid)
@@ -405,22 +531,68 @@ class api(object):
 					logger.info("user %s lang is not en" % uid)
 					continue
 			X = self.buildX(poms_tweets, predict=True)
-			
+			assignment = None
+			if self.near_duplicates and X.shape[0]:
+				representatives, assignment = \
+					self.near_duplicates.collapse(self.featuresWords())
+				logger.debug("%d - %d tweets scored out of %d"
+							 % (i, len(representatives), X.shape[0]))
+				X = X[representatives]
+
 			preds = []
 			for label in label_names:
 				# raw predicted probability scores
 				if raw:
-					preds.append(classifiers[label].predict_proba(X).tolist())
+					proba = classifiers[label].predict_proba(X)
+					if assignment is not None:
+						# the scores of the representatives of the tweets
+						proba = proba[assignment]
+					preds.append(proba.tolist())
 				# classification
 				else:
 					y_pred_proba = classifiers[label].predict_proba(X)[:, 1]
 					pred = map(lambda x: 0 if x < probability else 1,
 							   y_pred_proba)
+					if assignment is not None:
+						# a representative counts for all the tweets of its group
+						pred = np.take(pred, assignment)
 					ones = float(np.count_nonzero(pred))
 					score = ones/score_denom
 					preds.append(score)
 			print_results((uid,preds))
 
+	def featuresWords(self):
+		"""
+		Return value:
+		The list of the sets of the features of the tweets given to the last
+		call to buildX, as the words compared by duplicates.NearDuplicates.
+		The hashed features are named after the columns of their matrix.
+		"""
+		words = self.near_duplicates.words
+		if sp.issparse(self.features):
+			names = self.features_names
+			indices, indptr = self.features.indices, self.features.indptr
+			return [words(" ".join(names[c]
+								   for c in indices[indptr[j]:indptr[j + 1]]))
+					for j in xrange(self.features.shape[0])]
+		return map(words, self.features)
+
+	def trainClassifiers(self):
+		"""
+		Trains a copy of the classifier for each label of the corpus given to
+		buildX.
+
+		Return value:
+		A dictionary containing the trained classifier of every label.
+		"""
+		classifiers = {}
+		for label in self.labels[0].keys():
+			X_train = self.X
+			y_train = np.array([d[label] for d in self.labels])
+			self.clf.fit(X_train, y_train)
+			classifiers[label] = copy.deepcopy(self.clf)
+		return classifiers
+
 	def classifyUser(self, users_dir, uids, forbid=set(), probability=0.5,
 					 sporty=False, poms=False, raw=False):
 		"""
@@ -445,12 +617,7 @@ class api(object):
 
 		# Build classifiers for each dimension
 		label_names = self.labels[0].keys()
-		classifiers = {}
-		for label in label_names:
-			X_train = self.X
-			y_train = np.array([d[label] for d in self.labels])
-			self.clf.fit(X_train, y_train)
-			classifiers[label] = copy.deepcopy(self.clf)
+		classifiers = self.trainClassifiers()
 
 		auto_hash = set(['foursquare', 'yelp'])
 		requested = None
@@ -461,6 +628,7 @@ class api(object):
 			requested = poms_AH | poms_DD | poms_TA
 		proc_count = 1 #multiprocessing.cpu_count()
 		uids_q = Queue()
+		profiles = Queue()
 		stdout_lock = Lock()
 		processes = []
 		# Copy uids to process into task queue
@@ -474,12 +642,53 @@ class api(object):
 			p = Process(target=self._classifyUser_onethread,
 				    args=(forbid, auto_hash, requested, sporty, classifiers,
 					  users_dir, uids_q, label_names, probability, i,
-					  stdout_lock, raw))
+					  stdout_lock, raw, profiles))
 			processes.append(p)
 			p.start()
+		for p in processes:
+			durations = profiles.get()
+			if self.profiler:
+				self.profiler.merge(durations)
 		for p in processes:
 			p.join()
 
+	def scoreStream(self, corpus, batch_size=1000):
+		"""
+		Scores the tweets of a corpus as they are read, the corpus being
+		possibly unbounded (e.g. the tweets printed by 'stream collect'). The
+		features of the tweets are built by batches with the options and the
+		pipeline of the last call to buildX, and scaled with the statistics
+		of the features of the corpus given to buildX, so that the scores of
+		a tweet do not depend on its batch. Retweets are skipped.
+
+		Parameters:
+		corpus - iterable over the tweets to score
+		batch_size - number of tweets whose features are built at once, the
+					 memory used being bounded by the size of a batch. The
+					 scores of a batch are only yielded once all its tweets
+					 are read.
+
+		Return value:
+		An iterator over the pairs (tweet, scores), scores being the list of
+		the probabilities for the tweet to be positive for every label, in
+		the order of the labels of the corpus given to buildX.
+		"""
+		label_names = self.labels[0].keys()
+		classifiers = self.trainClassifiers()
+		fb_options = dict(self.fb_options, keep_rt=False, labels=False,
+						  chunk_size=batch_size)
+		cl = utils.Cleaner(memo=self.cleaner_memo, **self.cleaner_options)
+		fb = utils.FeaturesBuilder(corpus, cleaner=cl, **fb_options)
+		for batch in fb.batches(self.pipeline.transform):
+			tweets = [tw for tw, kept in zip(batch.tweets, batch.twids) if kept]
+			if not tweets:
+				continue
+			X = self.scaler.transform(batch.features.toarray())
+			probas = [classifiers[label].predict_proba(X)[:, 1]
+					  for label in label_names]
+			for i, tw in enumerate(tweets):
+				yield tw, [p[i] for p in probas]
+
 	def match_users(self, sport_file, no_sport_file, match_file, random_file=None):
 		"""
 		Concatenate the scores of the exercising user and its match.
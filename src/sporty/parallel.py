@@ -0,0 +1,224 @@
+''' Reading tweets with several processes.
+
+UsersReader reads the tweets of the users of a users directory (one file of
+tweets per user, possibly compressed, or an archive) in a pool of processes,
+which decode the tweets and send them to the reading process by batches.
+map_ranges processes a single large file of tweets split in ranges of lines
+(see Tweets.split) in a pool of processes.
+'''
+
+import logging
+import multiprocessing
+import os
+from archive import Archive, find_user
+from collections import defaultdict
+from compression import find
+from datastructures import Tweets
+from multiprocessing import Process, Queue
+
+
+def run_pool(work, tasks, workers, queue_size):
+    """
+    Runs worker processes and yields their results.
+
+    Parameters:
+    work       - function called by every worker with the queue of the tasks
+                 and the queue of the results. It must process the tasks until
+                 it gets a None task, and then put None on the results queue.
+    tasks      - list of the tasks
+    workers    - number of worker processes
+    queue_size - maximum number of results waiting to be consumed
+    """
+    tasks_q = Queue()
+    results = Queue(queue_size)
+    for t in tasks:
+        tasks_q.put(t)
+    # kill pills so that the workers exit
+    for i in range(workers):
+        tasks_q.put(None)
+    processes = [Process(target=work, args=(tasks_q, results))
+                 for i in range(workers)]
+    for p in processes:
+        p.daemon = True
+        p.start()
+    try:
+        running = len(processes)
+        while running:
+            item = results.get()
+            if item is None:
+                running -= 1
+            else:
+                yield item
+    finally:
+        # the consumer may stop before the end
+        for p in processes:
+            if p.is_alive():
+                p.terminate()
+            p.join()
+
+
+def list_users(users_dir):
+    """
+    Return value:
+    The sorted list of the ids of the users whose tweets are stored in the
+    given users directory or archive.
+    """
+    if Archive.is_archive(users_dir):
+        return sorted(Archive.open(users_dir).uids())
+    return sorted(set(uid for uid, name in Tweets.users_files(users_dir)))
+
+
+class UsersReader(object):
+    """
+    Iterates over the tweets of many users, yielding pairs (uid, batch) where
+    batch is a list of at most batch_size tweets of the user uid. The files
+    are read and decoded by a pool of worker processes; at most queue_size
+    batches wait to be consumed, the workers being blocked when the consumer
+    is slower than them.
+
+    The batches of a user are yielded in the order of its tweets, but the
+    batches of users read by different workers are interleaved. Every user
+    yields at least one batch, empty if it has no tweets.
+
+        for uid, batch in UsersReader(users_dir, workers=4):
+            counts[uid] += len(batch)
+    """
+    def __init__(self, users_dir, uids=None, workers=None, batch_size=500,
+                 fields=None, queue_size=None):
+        """
+        Parameters:
+        users_dir  - directory of the tweets of the users, or archive
+        uids       - ids of the users to read, all the users of users_dir by
+                     default
+        workers    - number of worker processes, one per CPU by default. The
+                     tweets are read by the current process if it is 1.
+        batch_size - maximum number of tweets in a batch
+        fields     - dotted paths of the fields to keep when decoding the
+                     tweets (see decoder.Decoder), None to keep whole tweets
+        queue_size - maximum number of batches waiting to be consumed, twice
+                     the number of workers by default
+        """
+        super(UsersReader, self).__init__()
+        self.users_dir = users_dir
+        self.uids = uids if uids is not None else list_users(users_dir)
+        self.workers = workers if workers else multiprocessing.cpu_count()
+        self.batch_size = max(1, batch_size)
+        self.fields = fields
+        self.queue_size = queue_size if queue_size else 2 * self.workers
+
+    def read(self, uid):
+        """
+        Yields the batches of tweets of a user.
+        """
+        path = os.path.join(self.users_dir, str(uid))
+        if not (find(path) or find_user(path)):
+            logging.warning("No tweets found for user %s in %s."
+                            % (uid, self.users_dir))
+            yield []
+            return
+        batch = []
+        sent = False
+        with Tweets(path, 'r', fields=self.fields) as tweets:
+            for tw in tweets:
+                batch.append(tw)
+                if len(batch) >= self.batch_size:
+                    yield batch
+                    batch = []
+                    sent = True
+        if batch or not sent:
+            yield batch
+
+    def _work(self, tasks, results):
+        """
+        Reads the users received on the tasks queue until a None task is
+        received, and puts their batches on the results queue.
+        """
+        for uid in iter(tasks.get, None):
+            try:
+                for batch in self.read(uid):
+                    results.put((uid, batch))
+            except Exception, e:
+                logging.error("Cannot read the tweets of user %s: %s"
+                              % (uid, e))
+        results.put(None)
+
+    def __iter__(self):
+        if self.workers == 1:
+            for uid in self.uids:
+                for batch in self.read(uid):
+                    yield uid, batch
+            return
+        for item in run_pool(self._work, self.uids, self.workers,
+                             self.queue_size):
+            yield item
+
+
+def map_ranges(tweets, func, workers=None, ordered=True, ranges=None,
+               batch_size=500, queue_size=None):
+    """
+    Applies a function to the tweets of a file split in ranges of lines (see
+    Tweets.split), the ranges being processed by a pool of worker processes.
+
+    Parameters:
+    tweets     - Tweets instance reading a file
+    func       - function called with an iterator over the tweets of a range
+                 and returning an iterable of outputs, which must be picklable
+    workers    - number of worker processes, one per CPU by default. The
+                 ranges are processed by the current process if it is 1.
+    ordered    - True to yield the outputs in the order of the ranges, i.e. as
+                 if the whole file was given to func, False to yield them as
+                 soon as they are received. Outputs received before those of
+                 the previous ranges are kept in memory until then.
+    ranges     - number of ranges, four per worker by default so that the
+                 ranges are balanced between the workers
+    batch_size - number of outputs sent at once by a worker
+    queue_size - maximum number of batches waiting to be consumed, twice the
+                 number of workers by default
+
+    Return value:
+    An iterator over the outputs of func.
+    """
+    workers = workers if workers else multiprocessing.cpu_count()
+    bounds = tweets.split(ranges if ranges else 4 * workers)
+    if workers == 1:
+        for start, end in bounds:
+            for out in func(tweets.read_range(start, end)):
+                yield out
+        return
+
+    def work(tasks, results):
+        for i, start, end in iter(tasks.get, None):
+            try:
+                batch = []
+                for out in func(tweets.read_range(start, end)):
+                    batch.append(out)
+                    if len(batch) >= batch_size:
+                        results.put((i, batch, False))
+                        batch = []
+                results.put((i, batch, True))
+            except Exception, e:
+                logging.error("Cannot process range %d of %s: %s"
+                              % (i, tweets.path, e))
+                results.put((i, e, True))
+        results.put(None)
+
+    tasks = [(i, start, end) for i, (start, end) in enumerate(bounds)]
+    pending = defaultdict(list)   # outputs received before their turn
+    finished = set()
+    current = 0     # range whose outputs are yielded
+    for i, batch, last in run_pool(work, tasks, workers,
+                                   queue_size if queue_size else 2 * workers):
+        if isinstance(batch, Exception):
+            raise Exception("Error while processing range %d of %s: %s"
+                            % (i, tweets.path, batch))
+        if not ordered or i == current:
+            for out in batch:
+                yield out
+        else:
+            pending[i].extend(batch)
+        if last:
+            finished.add(i)
+        while ordered and current in finished:
+            current += 1
+            for out in pending.pop(current, []):
+                yield out
@@ -0,0 +1,109 @@
+''' Timing of the stages of the features extraction.
+
+A Profiler records the wall time of every call to the functions it wraps,
+grouped by stage (a step of the Cleaner, a features extractor, the TF-IDF
+pipeline...). Only the wrapped functions are timed, so that nothing is
+measured, and nothing slows down, when no profiler is given.
+
+    >>> p = Profiler()
+    >>> square = p.timed('square', lambda x: x * x)
+    >>> [square(x) for x in range(4)]
+    [0, 1, 4, 9]
+    >>> stats = p.stats()
+    >>> stats['stages']['square']['calls']
+    4
+    >>> sorted(stats['stages']['square'])
+    ['calls', 'max', 'mean', 'p50', 'p90', 'p99', 'total']
+'''
+
+import json
+import numpy as np
+import time
+from array import array
+from collections import defaultdict
+
+
+class Profiler(object):
+    """
+    Call counts and wall times of stages. The durations recorded by a forked
+    process can be sent to the parent process with drain and merge.
+    """
+    def __init__(self):
+        super(Profiler, self).__init__()
+        self.durations = defaultdict(lambda: array('d'))
+
+    def timed(self, stage, f):
+        """
+        Return value:
+        A function calling f and recording the duration of the call in the
+        given stage.
+        """
+        durations = self.durations[stage]
+        clock = time.time
+
+        def timed_f(*args, **kwargs):
+            start = clock()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                durations.append(clock() - start)
+        return timed_f
+
+    def drain(self):
+        """
+        Removes the recorded durations.
+
+        Return value:
+        The dictionary of the lists of the removed durations by stage.
+        """
+        drained = {}
+        for stage, durations in self.durations.iteritems():
+            if durations:
+                drained[stage] = durations.tolist()
+                # the durations are referenced by the timed functions
+                del durations[:]
+        return drained
+
+    def merge(self, drained):
+        """
+        Adds durations returned by the drain method of another profiler.
+        """
+        for stage, durations in drained.iteritems():
+            self.durations[stage].extend(durations)
+
+    def stats(self):
+        """
+        Return value:
+        A dictionary containing, for every stage, the number of calls and the
+        total, mean, median, 90th and 99th percentiles and maximum durations
+        in seconds. The number of tweets whose features were extracted and
+        the number of tweets extracted per second are added when the
+        'builder.extract' and 'builder.run' stages were timed.
+        """
+        stages = {}
+        for stage, durations in self.durations.iteritems():
+            if not durations:
+                continue
+            d = np.frombuffer(durations, dtype=np.float64)
+            p50, p90, p99 = np.percentile(d, [50, 90, 99])
+            stages[stage] = {'calls': len(d),
+                             'total': float(d.sum()),
+                             'mean': float(d.mean()),
+                             'p50': float(p50),
+                             'p90': float(p90),
+                             'p99': float(p99),
+                             'max': float(d.max())}
+        stats = {'stages': stages}
+        if 'builder.extract' in stages:
+            stats['tweets'] = stages['builder.extract']['calls']
+            if stages.get('builder.run', {}).get('total'):
+                stats['tweets_per_sec'] = stats['tweets'] \
+                    / stages['builder.run']['total']
+        return stats
+
+    def dump(self, path):
+        """
+        Writes the statistics of the stages in a JSON file.
+        """
+        with open(path, 'w') as f:
+            json.dump(self.stats(), f, indent=2, sort_keys=True)
@@ -0,0 +1,291 @@
+""" Columnar "slim corpus" format for tweets.
+
+A slim corpus only keeps the fields of the tweets used by the sporty APIs
+(id, text, entities, user, place and the POMS labels), user objects being
+reduced to USER_FIELDS and stored once when identical. It is stored in a
+directory containing:
+    - meta.json: format, version, number of tweets and stored labels
+    - id.npy, flags.npy, user.npy and <label>.npy: one numpy array per field
+    - <field>.heap and <field>.offsets.npy: the UTF-8 strings of a field
+      concatenated in a heap, and the offsets of every string in the heap
+
+The arrays are memory-mapped, so loading a corpus only costs a few reads and
+tweets are rebuilt on access instead of decoding their JSON.
+"""
+
+import json
+import mmap
+import os
+import shutil
+import tempfile
+import numpy as np
+
+FORMAT = 'sporty-slim'
+VERSION = 1
+LABELS = ('AH', 'DD', 'TA')
+USER_FIELDS = ('id', 'id_str', 'name', 'screen_name', 'lang', 'location',
+               'statuses_count', 'friends_count', 'followers_count')
+HAS_PLACE = 1
+
+
+class StringHeap(object):
+    """
+    Sequence of strings stored in a heap file and an array of offsets.
+    """
+    def __init__(self, directory, name):
+        """
+        Parameters:
+        directory - directory of the slim corpus
+        name      - name of the field stored in the heap
+        """
+        super(StringHeap, self).__init__()
+        self.offsets = np.load(os.path.join(directory, name + '.offsets.npy'),
+                               mmap_mode='r')
+        heap_path = os.path.join(directory, name + '.heap')
+        self.heap = ''
+        if os.path.getsize(heap_path):
+            with open(heap_path, 'rb') as f:
+                self.heap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        """
+        Return value:
+        The i-th string if i is an integer, or the list of the selected
+        strings if i is a slice.
+        """
+        if isinstance(i, slice):
+            return [self[j] for j in xrange(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if i < 0 or i >= len(self):
+            raise IndexError("string heap index out of range")
+        return self.heap[self.offsets[i]:self.offsets[i + 1]].decode('utf-8')
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+    def tolist(self):
+        return list(self)
+
+
+class StringHeapWriter(object):
+    """
+    Writes a sequence of strings in a heap file and an array of offsets.
+    """
+    def __init__(self, directory, name):
+        super(StringHeapWriter, self).__init__()
+        self.directory = directory
+        self.name = name
+        self.heap = open(os.path.join(directory, name + '.heap'), 'wb')
+        self.offsets = [0]
+
+    def add(self, s):
+        if type(s) == unicode:
+            s = s.encode('utf-8')
+        self.heap.write(s)
+        self.offsets.append(self.offsets[-1] + len(s))
+
+    def close(self):
+        self.heap.close()
+        np.save(os.path.join(self.directory, self.name + '.offsets.npy'),
+                np.array(self.offsets, dtype=np.int64))
+
+
+class SlimCorpus(object):
+    """
+    Read-only access to a slim corpus. Tweets are rebuilt as dictionaries
+    containing the fields used by the sporty APIs, and every field can be
+    read as a column.
+    """
+    heaps = ('text', 'hashtags', 'urls', 'user_mentions', 'place')
+
+    def __init__(self, directory):
+        """
+        Parameters:
+        directory - directory of the slim corpus
+        """
+        super(SlimCorpus, self).__init__()
+        self.directory = directory
+        with open(os.path.join(directory, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self.count = self.meta['count']
+        self.labels = self.meta['labels']
+        self.columns = {}
+        for name in ['id', 'flags', 'user'] + self.labels:
+            path = os.path.join(directory, name + '.npy')
+            self.columns[name] = np.load(path, mmap_mode='r')
+        for name in self.heaps:
+            self.columns[name] = StringHeap(directory, name)
+        self.users = StringHeap(directory, 'users')
+        self.users_cache = {}
+
+    @staticmethod
+    def is_slim(path):
+        """
+        Return value:
+        True if the given path is the directory of a slim corpus, False
+        otherwise.
+        """
+        meta_path = os.path.join(path, 'meta.json')
+        if not os.path.isfile(meta_path):
+            return False
+        with open(meta_path) as f:
+            try:
+                return json.load(f).get('format') == FORMAT
+            except ValueError:
+                return False
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        for i in xrange(self.count):
+            yield self[i]
+
+    def user(self, i):
+        """
+        Return value:
+        A copy of the user object of the i-th tweet, None if it has no user.
+        Every distinct user object is only decoded once.
+        """
+        u = int(self.columns['user'][i])
+        if u < 0:
+            return None
+        if u not in self.users_cache:
+            self.users_cache[u] = json.loads(self.users[u])
+        return dict(self.users_cache[u])
+
+    def __getitem__(self, i):
+        """
+        Return value:
+        The i-th tweet rebuilt as a dictionary.
+        """
+        if i < 0:
+            i += self.count
+        if i < 0 or i >= self.count:
+            raise IndexError("tweet index out of range")
+        c = self.columns
+        place = None
+        if c['flags'][i] & HAS_PLACE:
+            place = {'full_name': c['place'][i]}
+        tw = {'id': int(c['id'][i]),
+              'text': c['text'][i],
+              'entities': {
+                  'hashtags': [{'text': h} for h in c['hashtags'][i].split()],
+                  'urls': [{'url': u} for u in c['urls'][i].split()],
+                  'user_mentions': [{'screen_name': m}
+                                    for m in c['user_mentions'][i].split()]
+                  },
+              'user': self.user(i),
+              'place': place}
+        for l in self.labels:
+            if c[l][i] >= 0:
+                tw[l] = int(c[l][i])
+        return tw
+
+    def column(self, name):
+        """
+        Return value:
+        The values of the given field for every tweet: a numpy array for ids,
+        flags and labels, a sequence of strings for text, hashtags, urls,
+        user_mentions (space-separated) and place names.
+        """
+        if name in self.columns:
+            return self.columns[name]
+        raise KeyError("No column %s in slim corpus %s." % (name,
+                                                            self.directory))
+
+
+def convert(tweets, directory, labels=LABELS):
+    """
+    Converts tweets to a slim corpus. The files of the corpus are written in
+    a temporary directory and moved to the given directory once they are all
+    written, meta.json last, so that a failed conversion leaves no partial
+    corpus.
+
+    Parameters:
+    tweets    - iterable of tweets as dictionaries (e.g. a Tweets instance)
+    directory - directory where the slim corpus is written
+    labels    - label fields to keep when they are present in the tweets
+
+    Return value:
+    The number of converted tweets.
+    """
+    parent = os.path.dirname(os.path.abspath(directory))
+    if not os.path.isdir(parent):
+        os.makedirs(parent)
+    # in the parent directory, so that the files are moved by renaming them
+    tmp = tempfile.mkdtemp(prefix=os.path.basename(directory) + '.tmp-',
+                           dir=parent)
+    try:
+        count = _convert(tweets, tmp, labels)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        names = sorted(os.listdir(tmp), key=lambda n: n == 'meta.json')
+        for name in names:
+            os.rename(os.path.join(tmp, name), os.path.join(directory, name))
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    return count
+
+
+def _convert(tweets, directory, labels):
+    """
+    Writes the files of the slim corpus of tweets in a directory, see
+    convert.
+    """
+    writers = dict((name, StringHeapWriter(directory, name))
+                   for name in SlimCorpus.heaps + ('users',))
+    ids = []
+    flags = []
+    users = []
+    users_idx = {}
+    label_values = dict((l, []) for l in labels)
+    for tw in tweets:
+        entities = tw.get('entities') or {}
+        ids.append(tw.get('id', 0))
+        writers['text'].add(tw.get('text') or '')
+        # entities missing their field are not kept
+        writers['hashtags'].add(' '.join(h.get('text') or '' for h in
+                                         entities.get('hashtags', [])))
+        writers['urls'].add(' '.join(u.get('url') or '' for u in
+                                     entities.get('urls', [])))
+        writers['user_mentions'].add(' '.join(m.get('screen_name') or ''
+                                              for m in
+                                              entities.get('user_mentions',
+                                                           [])))
+        place = tw.get('place')
+        writers['place'].add(place.get('full_name') or '' if place else '')
+        flags.append(HAS_PLACE if place else 0)
+        user = tw.get('user')
+        if user:
+            user = dict((k, user[k]) for k in USER_FIELDS if k in user)
+            encoded = json.dumps(user, sort_keys=True)
+            if encoded not in users_idx:
+                users_idx[encoded] = len(users_idx)
+                writers['users'].add(encoded)
+            users.append(users_idx[encoded])
+        else:
+            users.append(-1)
+        for l in labels:
+            label_values[l].append(int(tw[l]) if l in tw else -1)
+    for w in writers.values():
+        w.close()
+
+    np.save(os.path.join(directory, 'id.npy'), np.array(ids, dtype=np.int64))
+    np.save(os.path.join(directory, 'flags.npy'),
+            np.array(flags, dtype=np.uint8))
+    np.save(os.path.join(directory, 'user.npy'),
+            np.array(users, dtype=np.int32))
+    kept_labels = [l for l in labels if any(v >= 0 for v in label_values[l])]
+    for l in kept_labels:
+        np.save(os.path.join(directory, l + '.npy'),
+                np.array(label_values[l], dtype=np.int8))
+    with open(os.path.join(directory, 'meta.json'), 'w') as f:
+        json.dump({'format': FORMAT, 'version': VERSION, 'count': len(ids),
+                   'labels': kept_labels}, f)
+    return len(ids)
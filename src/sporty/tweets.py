@@ -6,6 +6,7 @@ import os
 from collections import defaultdict
 from utils import TwitterAPIUser
 from datastructures import Tweets
+from parallel import map_ranges
 
 
 class api(TwitterAPIUser):
@@ -27,48 +28,77 @@ class api(TwitterAPIUser):
         self.tweets = Tweets(input_file)
 
     def collect(self, tracked_words, output_file=None, mode='a+', count=0,
-                lang=["en-EN", "en", "en-CA", "en-GB"], locations=None):
+                lang=["en-EN", "en", "en-CA", "en-GB"], locations=None,
+                buffer_size=100, flush_interval=10, concurrent=None):
         """
         Given options, this function collects tweets using the Streaming API
-        and stores them in memory or on disk.
+        and stores them in memory or on disk. On disk, the tweets are written
+        by groups of buffer_size tweets, or every flush_interval seconds, in a
+        segment of the output file if concurrent is True so that several
+        collectors can write to the same output (see Segments).
         """
-        self.tweets = Tweets(output_file, mode)
+        self.tweets = Tweets(output_file, mode, buffer_size=buffer_size,
+                             flush_interval=flush_interval,
+                             concurrent=concurrent)
         i = 0
-        while True:
-            try:
-                r = self.getStatusStream(tracked_words, lang, locations)
-                for item in r.get_iterator():
-                    if 'limit' not in item.keys():
-                        self.tweets.append(item)
-                        i += 1
-                        if count and i >= count:
-                            break
-                break
-            except Exception, e:
-                # sys.stderr.write("ChunkedEncodingError\n")
-                continue
+        with self.tweets:
+            while True:
+                try:
+                    r = self.getStatusStream(tracked_words, lang, locations)
+                    for item in r.get_iterator():
+                        if 'limit' not in item.keys():
+                            self.tweets.append(item)
+                            i += 1
+                            if count and i >= count:
+                                break
+                    break
+                except Exception, e:
+                    # sys.stderr.write("ChunkedEncodingError\n")
+                    continue
 
     def filter(self, n, words, each_word=True, output_file=None, mode='a+',
-               rt=True):
+               rt=True, workers=1, concurrent=None):
         """
         Filter tweets from the loaded corpus by getting, for each term T in
-        the list 'words', n tweets that contains T.
+        the list 'words', n tweets that contains T. When the corpus is stored
+        in a file and workers is not 1, the tweets are decoded and matched
+        against the words by a pool of workers processes (see
+        parallel.map_ranges), one per CPU if workers is 0 or None, and only
+        the tweets containing some of the words are selected in order by the
+        current process. If concurrent is True, the selected tweets are
+        written in a segment of the output file (see Segments).
         """
-        self.filtered_tweets = Tweets(output_file, mode)
+        self.filtered_tweets = Tweets(output_file, mode, concurrent=concurrent)
         self.words_filtered = set(words)
+        # the tweets kept in memory are appended as dictionaries
+        encode = type(self.filtered_tweets.tweets) != list
+
+        def candidates(tweets):
+            # the tweets that contain none of the words are never selected,
+            # the others are encoded where they are decoded when they are
+            # written to a file, as they would be by a single process
+            for tw in tweets:
+                text = tw['text']
+                tw_rt = text.find("RT") != -1
+                if not rt and tw_rt:
+                    continue
+                terms = set(x.lower() for x in re.split("\s+", text))
+                inter = terms.intersection(self.words_filtered)
+                if inter:
+                    yield json.dumps(tw) if encode else tw, inter
+
+        if workers != 1 and self.tweets.lazy:
+            matched = map_ranges(self.tweets, candidates, workers)
+        else:
+            matched = candidates(self.tweets)
 
         # initialize count variables
         count = 0
 
         # Process each tweet
-        for tw in self.tweets:
-            text = tw['text']
-            tw_rt = text.find("RT") != -1
-            if not rt and tw_rt:
-                continue
+        for tw, inter in matched:
             # check that the words we look for are present in this tweet
-            terms = set(x.lower() for x in re.split("\s+", text))
-            inter = terms.intersection(self.words_filtered)
+            inter = inter.intersection(self.words_filtered)
 
             # once we have found n tweets containing the word w, we remove the
             # word w from our search list
@@ -5,12 +5,21 @@ import re
 import requests
 import sys
 import time
+from archive import Archive, find_user
 from collections import defaultdict
+from compression import find, get_codec, open_file
 from datastructures import LSF
+from decoder import Decoder
 from scipy.spatial.distance import cosine
 from tweets import Tweets
 from utils import TwitterAPIUser
 
+# fields of the users and tweets read when matching users with their friends
+USER_FIELDS = ['id', 'name', 'location', 'statuses_count', 'friends_count',
+               'followers_count']
+user_decoder = Decoder(['user.' + f for f in USER_FIELDS])
+friend_decoder = Decoder(USER_FIELDS)
+
 
 class api(TwitterAPIUser):
     def __init__(self, user_ids=[], settings_file=None):
@@ -156,50 +165,70 @@ class api(TwitterAPIUser):
                 for friend_id in friends:
                     f.write(str(friend_id) + "\n")
 
-    def collectTweets(self, output_dir="./", count=3200):
+    def collectTweets(self, output_dir="./", count=3200, buffer_size=200,
+                      flush_interval=30, compress=None, resume=False):
         """
-        Returns the 3200 last tweets of every user in user_ids.
+        Returns the 3200 last tweets of every user in user_ids. The tweets are
+        written to disk by groups of buffer_size tweets, or every
+        flush_interval seconds, in files compressed with the given format
+        ('gzip', 'zstd' or 'lz4') if compress is set. Users whose tweets have
+        already been collected are skipped, unless resume is True in which
+        case their collection continues from their oldest collected tweet.
+        If output_dir is an archive (see the archive module), the tweets are
+        appended to the archive instead of being written in one file per
+        user, and are not compressed.
         """
+        archived = Archive.is_archive(output_dir)
         for user_id in self.user_ids:
             user_path = os.path.join(output_dir, user_id)
-            if os.path.isfile(user_path):
-                # if friends list already exists for this user
+            existing = find_user(user_path) if archived else find(user_path)
+            if existing and not resume:
+                # if the tweets already exist for this user
                 continue
-            tweets = Tweets(user_path, 'a+')
-            i = 0
-            max_id = 0
-            keep_try = True
-            while keep_try:
-                try:
-                    r = self.getUserStream(user_id, max_id=max_id)
-                    if not r.get_iterator().results:
-                        keep_try = False
-                    for item in r.get_iterator():
-                        if 'error' in response.keys() and response['error'] == 'Not authorized.':
-                            cursor = 0
-                            break
-                        if 'message' in item.keys():
-                            remaining = r.get_rest_quota()['remaining']
-                            if not remaining:
-                                sleep_min = 5
-                                sleep_sec = sleep_min*60
-                                self.__msg_wait(sleep_sec)
-                                break
-                            else:
-                                sys.stderr.write(str(item) + "\n")
-                        elif 'errors' in item.keys():
-                            continue
-                        else:
-                            max_id = item['id'] - 1
-                            tweets.append(item)
-                            i += 1
-                            if count and i >= count:
+            if existing:
+                user_path = existing
+            elif compress and not archived:
+                user_path += get_codec(compress).extension
+            with Tweets(user_path, 'a+', buffer_size=buffer_size,
+                        flush_interval=flush_interval) as tweets:
+                i = 0
+                max_id = 0
+                if existing:
+                    i = tweets.size()
+                    if i:
+                        max_id = tweets[-1]['id'] - 1
+                keep_try = not (count and i >= count)
+                while keep_try:
+                    try:
+                        r = self.getUserStream(user_id, max_id=max_id)
+                        if not r.get_iterator().results:
+                            keep_try = False
+                        for item in r.get_iterator():
+                            if 'error' in item.keys() and item['error'] == 'Not authorized.':
                                 keep_try = False
                                 break
-                except Exception, e:
-                    if item:
-                        sys.stderr.write(str(item) + "\n")
-                    raise e
+                            if 'message' in item.keys():
+                                remaining = r.get_rest_quota()['remaining']
+                                if not remaining:
+                                    sleep_min = 5
+                                    sleep_sec = sleep_min*60
+                                    self.__msg_wait(sleep_sec)
+                                    break
+                                else:
+                                    sys.stderr.write(str(item) + "\n")
+                            elif 'errors' in item.keys():
+                                continue
+                            else:
+                                max_id = item['id'] - 1
+                                tweets.append(item)
+                                i += 1
+                                if count and i >= count:
+                                    keep_try = False
+                                    break
+                    except Exception, e:
+                        if item:
+                            sys.stderr.write(str(item) + "\n")
+                        raise e
 
     def extendFromIds(self):
         """
@@ -249,23 +278,30 @@ class api(TwitterAPIUser):
         """
         Load the details of a user given its user identifier.
         """
-        user_file = os.path.join(user_dir, str(uid))
-        if os.path.isfile(user_file):
-            with open(user_file) as uf:
+        user_path = os.path.join(user_dir, str(uid))
+        if find_user(user_path):
+            # user stored in an archive
+            with Tweets(user_path, 'r', fields=user_decoder.fields) as tweets:
+                for tw in tweets:
+                    return tw['user']
+            return None
+        user_file = find(user_path)
+        if user_file:
+            with open_file(user_file) as uf:
                 line = uf.readline()
                 if line:
-                    tw = json.loads(line)
+                    tw = user_decoder(line)
                     user = tw['user']
                     return user
         else:
             return False
 
     def __getFriends(self, uid, friends_dir):
-        friends_file = os.path.join(friends_dir, str(uid) + '.extended')
-        if os.path.isfile(friends_file):
-            with open(friends_file) as ff:
+        friends_file = find(os.path.join(friends_dir, str(uid) + '.extended'))
+        if friends_file:
+            with open_file(friends_file) as ff:
                 for line in ff:
-                    yield json.loads(line)
+                    yield friend_decoder(line)
 
     def __processUser(self, u, males, females, user_dir, friends_dir,
                       use_tweets=True, is_friend=False):
@@ -279,7 +315,8 @@ class api(TwitterAPIUser):
                 return u, False
             else:
                 inspected.append(u['id'])
-            utweets = Tweets(os.path.join(user_dir, str(u['id'])))
+            utweets = Tweets(os.path.join(user_dir, str(u['id'])),
+                             fields=['place.full_name'])
             found_location = False
 
             for t in utweets:
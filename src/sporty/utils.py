@@ -1,15 +1,281 @@
 import codecs
 import json
+import multiprocessing
+import numpy as np
 import os.path
 import re
+import scipy.sparse as sp
 import string
 import sys
 import time
 from TwitterAPI import TwitterAPI
-from collections import defaultdict
+from collections import defaultdict, namedtuple
+from itertools import chain
+from operator import attrgetter
 from datastructures import *
 from lexicon import Lexicon
+from parallel import run_pool
 from sklearn.feature_extraction.text import CountVectorizer
+from sklearn.utils import murmurhash3_32
+
+
+def trie_regex(words):
+    """
+    Builds a regular expression matching any of the given words, and the
+    longest of them when several words match at the same position. The words
+    are factored in a trie, so that the expression does not try every word at
+    every position of a text.
+
+    >>> r = re.compile(trie_regex([':)', ':))', ':-)', ':(', '<3']))
+    >>> r.findall(':) :)) :-) :-( <3')
+    [':)', ':))', ':-)', '<3']
+    """
+    trie = {}
+    for w in words:
+        node = trie
+        for c in w:
+            node = node.setdefault(c, {})
+        node[''] = None  # end of a word
+
+    def build(node):
+        alternatives = [re.escape(c) + build(child)
+                        for c, child in sorted(node.items()) if c]
+        if not alternatives:
+            return ''
+        pattern = alternatives[0] if len(alternatives) == 1 \
+            else '(?:' + '|'.join(alternatives) + ')'
+        if '' in node:
+            # greedy: the longest word is preferred
+            pattern = '(?:' + pattern + ')?'
+        return pattern
+
+    return build(trie)
+
+
+class Tokenizer(object):
+    """
+    Splits texts in words, n-grams of words or n-grams of characters as the
+    analyzers of the CountVectorizer of scikit-learn do with lowercase=False
+    and no stop words, without building a vectorizer for every text. The
+    n-grams of words are joined with the given separator, a space for
+    CountVectorizer.
+
+    >>> texts = [u"great run today", u"run run run", u"a b c", u"",
+    ...          u"gym_time at 6am, 5k done!!", "str text  with   spaces",
+    ...          u"caf\\xe9 cr\\xe8me br\\xfbl\\xe9e"]
+    >>> def vectorizer_features(text, **options):
+    ...     try:
+    ...         vec = CountVectorizer(lowercase=False, **options)
+    ...         vec.fit_transform([text])
+    ...         return set(vec.get_feature_names())
+    ...     except ValueError:  # empty vocabulary
+    ...         return set()
+    >>> for options in [{}, {'ngram_range': (2, 2)}, {'ngram_range': (1, 3)},
+    ...                 {'analyzer': 'char_wb', 'ngram_range': (3, 3)},
+    ...                 {'analyzer': 'char_wb', 'ngram_range': (2, 4)}]:
+    ...     tokenizer = Tokenizer(**options)
+    ...     expected = [vectorizer_features(t, **options) for t in texts]
+    ...     print tokenizer.features_many(texts) == expected
+    True
+    True
+    True
+    True
+    True
+    >>> sorted(Tokenizer(ngram_range=(2, 2), separator='_').features(
+    ...     u"great run today"))
+    [u'great_run', u'run_today']
+    >>> Tokenizer()(u"run run a run")
+    [u'run', u'run', u'run']
+    """
+    token_regex = re.compile(r"(?u)\b\w\w+\b")
+    white_spaces_regex = re.compile(r"\s\s+")
+
+    def __init__(self, analyzer='word', ngram_range=(1, 1), separator=' '):
+        """
+        Parameters:
+        analyzer    - 'word' for n-grams of words, 'char_wb' for n-grams of
+                      characters inside the words
+        ngram_range - pair (min_n, max_n) of the sizes of the n-grams
+        separator   - string joining the words of the n-grams of words
+        """
+        super(Tokenizer, self).__init__()
+        if analyzer not in ('word', 'char_wb'):
+            raise Exception("Unknown analyzer %s: must be 'word' or 'char_wb'"
+                            % analyzer)
+        self.analyzer = analyzer
+        self.min_n, self.max_n = ngram_range
+        self.separator = separator
+
+    def __call__(self, text):
+        """
+        Return value:
+        The list of the n-grams of the given text, in their order of
+        appearance and with repetitions.
+        """
+        if isinstance(text, str):
+            text = text.decode('utf-8')
+        if self.analyzer == 'char_wb':
+            return self.char_ngrams(text)
+        return self.word_ngrams(self.token_regex.findall(text))
+
+    def word_ngrams(self, tokens):
+        if self.max_n == 1:
+            return tokens
+        min_n = self.min_n
+        ngrams = []
+        if min_n == 1:
+            ngrams.extend(tokens)
+            min_n = 2
+        join = self.separator.join
+        count = len(tokens)
+        for n in xrange(min_n, min(self.max_n, count) + 1):
+            ngrams.extend(join(tokens[i:i + n])
+                          for i in xrange(count - n + 1))
+        return ngrams
+
+    def char_ngrams(self, text):
+        ngrams = []
+        for w in self.white_spaces_regex.sub(" ", text).split():
+            w = ' ' + w + ' '
+            for n in xrange(self.min_n, self.max_n + 1):
+                if n >= len(w):
+                    # a short word is only counted once
+                    ngrams.append(w)
+                    break
+                ngrams.extend(w[i:i + n] for i in xrange(len(w) - n + 1))
+        return ngrams
+
+    def features(self, text):
+        """
+        Return value:
+        The set of the distinct n-grams of the given text.
+        """
+        # built from the sorted n-grams as from get_feature_names, so that
+        # the sets, and the features strings joined from them, are iterated
+        # in the same order
+        return set(sorted(set(self(text))))
+
+    def features_many(self, texts):
+        """
+        Return value:
+        The list of the sets of n-grams of the given texts.
+        """
+        return map(self.features, texts)
+
+
+class FeaturesHasher(object):
+    """
+    Maps features to the columns of a sparse matrix with the hashing trick,
+    so that no vocabulary of the features is built. Different features can
+    share a column.
+
+    >>> h = FeaturesHasher(16)
+    >>> names = {}
+    >>> X = h.transform([set([u'run', u'gym']), set(), set([u'run'])], names)
+    >>> X.shape, X.nnz
+    ((3, 16), 3)
+    >>> X[0, h.column(u'gym')], X[1].nnz, X[2, h.column(u'run')]
+    (1.0, 0, 1.0)
+    >>> sorted(names.values())
+    [u'gym', u'run']
+    """
+    def __init__(self, n_features=1 << 20):
+        """
+        Parameters:
+        n_features - number of columns of the matrices
+        """
+        super(FeaturesHasher, self).__init__()
+        self.n_features = n_features
+
+    def column(self, feature):
+        if isinstance(feature, unicode):
+            feature = feature.encode('utf-8')
+        return murmurhash3_32(feature, positive=True) % self.n_features
+
+    def transform(self, features_sets, names=None):
+        """
+        Parameters:
+        features_sets - list of the sets of features of the rows
+        names         - dictionary in which the first feature mapped to every
+                        column is stored, if given
+
+        Return value:
+        The CSR matrix whose rows have a 1 in the columns of their features,
+        or the number of their features sharing the column.
+        """
+        indices = []
+        indptr = [0]
+        column = self.column
+        for features in features_sets:
+            columns = [column(f) for f in features]
+            if names is not None:
+                for c, f in zip(columns, features):
+                    if c not in names:
+                        names[c] = f
+            indices.extend(columns)
+            indptr.append(len(indices))
+        X = sp.csr_matrix((np.ones(len(indices)), indices, indptr),
+                          shape=(len(features_sets), self.n_features))
+        X.sum_duplicates()
+        return X
+
+
+# views of a tweet read by the features extractors, see TweetRecord
+RAW = 'raw'
+CLEANED = 'cleaned'
+STRIPPED = 'stripped'
+TOKENS = 'tokens'
+
+
+class TweetRecord(namedtuple('TweetRecord', ['tweet', RAW, CLEANED, STRIPPED,
+                                             TOKENS])):
+    """
+    Views of a tweet built in a single pass by Cleaner.record:
+    tweet    - the tweet, which must not be modified
+    raw      - its text
+    cleaned  - its text cleaned by the cleaner, see Cleaner.clean_tw
+    stripped - its text cleaned by the cleaner and without punctuation, even
+               if the cleaner keeps the punctuation
+    tokens   - the tuple of the words of the cleaned text
+    """
+    __slots__ = ()
+
+
+# features of a batch of tweets, see FeaturesBuilder.batches: tweets is the
+# list of the tweets of the batch, and features, labels and twids are those of
+# FeaturesBuilder.run_chunk
+FeaturesBatch = namedtuple('FeaturesBatch', ['tweets', 'features', 'labels',
+                                             'twids'])
+
+# features extractors usable in the func_list of FeaturesBuilder, by name
+extractors = {}
+
+
+def extractor(view=RAW):
+    """
+    Decorator registering a features extractor under the name of the
+    function, so that it can be given in the func_list of a FeaturesBuilder.
+    An extractor is called with the builder, the view of the text of the
+    tweet it reads, the record of the tweet (see TweetRecord) and the set of
+    the features of the tweet, to which it adds its features:
+
+        @extractor(CLEANED)
+        def exclamationFeature(fb, text, record, features):
+            if '!' in text:
+                features.add("_EXCLAMATION_")
+
+    Parameters:
+    view - RAW, CLEANED, STRIPPED or TOKENS, the view read by the extractor.
+           The cleaned views are the raw text (or its words) when the
+           func_list has no 'clean' step. As the text is cleaned by the
+           'clean' step, a RAW extractor placed after it reads the cleaned
+           text and a CLEANED extractor placed before it the raw text.
+    """
+    def register(f):
+        f.view = view
+        extractors[f.__name__] = f
+        return f
+    return register
 
 
 class FeaturesBuilder(object):
@@ -21,7 +287,10 @@ class FeaturesBuilder(object):
                  keep_rt=True,
                  mini=50,
                  maxi=100,
-                 liwc_path=None):
+                 liwc_path=None,
+                 workers=1,
+                 chunk_size=1000,
+                 n_features=None):
         super(FeaturesBuilder, self).__init__()
         self.corpus = corpus
         if cleaner:
@@ -30,17 +299,25 @@ class FeaturesBuilder(object):
             self.cleaner = Cleaner()
         self.extract_labels = labels
         self.keep_rt = keep_rt
-        self.extractors = []
         self.mini = mini
         self.maxi = maxi
         self.features = []
         self.labels = []
         self.labels_reduce_f = labels_reduce_f
-        self.tw_features = set()
-        self.tweet = {}
+        # processes extracting the features, 0 or None for one per CPU
+        self.workers = workers
+        self.chunk_size = max(1, chunk_size)
+        # features hashed in n_features columns instead of joined in strings
+        self.hasher = FeaturesHasher(n_features) if n_features else None
+        self.names = None
+        self.tokenizers = {}
+        self.profiler = None
+        # strings shared by the cleaner, the lexicon and the features
+        self.vocabulary = self.cleaner.vocabulary
+        self.liwc_path = liwc_path
         self.lexicon = None
         if liwc_path:
-            self.lexicon = Lexicon(liwc_path)
+            self.lexicon = Lexicon(liwc_path, self.vocabulary)
         if not func_list:
             self.func_list = ['caseFeature',
                               'lengthFeature',
@@ -50,158 +327,516 @@ class FeaturesBuilder(object):
                               #'charTokenize',
                               'ngrams',
                               'mentionsFeature',
-                              'urlsFeature'
-                              'hashtagsFeature']
+                              #'urlsFeature',
+                              #'hashtagsFeature'
+                              ]
         else:
             self.func_list = func_list
+        self.extractors = self.compile(self.func_list)
+        # the tweets are only cleaned if there is a 'clean' step
+        self.cleaning = 'clean' in self.func_list
+
+    def compile(self, func_list):
+        """
+        Checks the names of the extractors of a func_list.
+
+        Return value:
+        The list of the pairs (extractor, view) to apply to every tweet, in
+        the order of func_list, the extractors being bound to the builder
+        and the views being functions returning the view of a record.
+        """
+        plan = []
+        cleaned = False
+        for name in func_list:
+            if name == 'clean':
+                cleaned = True
+                continue
+            if name not in extractors:
+                raise Exception(name + " is not a features extractor of "
+                                + "FeaturesBuilder.")
+            f = extractors[name]
+            bound = f.__get__(self)
+            if self.profiler:
+                bound = self.profiler.timed('extractor.' + name, bound)
+            # the text of the tweet is cleaned by the 'clean' step: the
+            # extractors before it read the raw text, the ones after it the
+            # cleaned text
+            view = f.view
+            if view == RAW and cleaned:
+                view = CLEANED
+            elif view == CLEANED and not cleaned:
+                view = RAW
+            plan.append((bound, attrgetter(view)))
+        return plan
 
-    def clean(self): 
-        self.tweet = self.cleaner.clean_tw(self.tweet)
+    def profile(self, profiler):
+        """
+        Records the durations of the extraction of the features of every
+        tweet ('builder.extract'), of every extractor ('extractor.<name>'),
+        of the hashing of every chunk ('builder.hash') and of the steps of
+        the cleaner in the given profiler (see profiling.Profiler).
+        """
+        self.profiler = profiler
+        self.extractors = self.compile(self.func_list)
+        self.extract_set = profiler.timed('builder.extract',
+                                          FeaturesBuilder.extract_set
+                                          .__get__(self))
+        if self.hasher:
+            self.hasher.transform = profiler.timed('builder.hash',
+                                                   FeaturesHasher.transform
+                                                   .__get__(self.hasher))
+        self.cleaner.profile(profiler)
 
-    def tokenize(self, analyzer='word', ngram_range=(1, 1)):
-        text = self.tweet['text']
+    def tokenizer(self, analyzer='word', ngram_range=(1, 1), separator=' '):
+        """
+        Return value:
+        The tokenizer with the given options, built once per builder.
+        """
+        key = (analyzer, ngram_range, separator)
+        if key not in self.tokenizers:
+            self.tokenizers[key] = Tokenizer(analyzer, ngram_range, separator)
+        return self.tokenizers[key]
+
+    def tokenize(self, text, features, analyzer='word', ngram_range=(1, 1)):
         if text:
-            vec = CountVectorizer(analyzer=analyzer, ngram_range=ngram_range,
-                                  lowercase=False)
-            vec.fit_transform([text])
-            self.tw_features = self.tw_features.union(set(vec.get_feature_names()))
-
-    def wordTokenize(self):
-        try:
-            self.tokenize()
-        except ValueError, e:
-            pass
-            # sys.stderr.write(self.tweet['text'] + "\n")
-            # sys.stderr.write(repr(e) + "\n")
-
-    def charTokenize(self):
-        try:
-            self.tokenize(analyzer='char_wb', ngram_range=(3, 3))
-        except ValueError, e:
-            pass
-            # sys.stderr.write(self.tweet['text'] + "\n")
-            # sys.stderr.write(repr(e) + "\n")
-
-    def ngrams(self, ngram_range=(2, 2)):
-        tw_save = self.tweet
-        if not self.cleaner.rm_punctuation:
-            self.cleaner.rm_punctuation = True
-            self.tweet = self.cleaner.clean_tw(self.tweet)
-        text = self.tweet['text']
-        try:
-            if text and -1 != text.find(' '):
-                ngrams = CountVectorizer(ngram_range=ngram_range, analyzer='word',
-                                         lowercase=False, stop_words=None)
-                ngrams.fit_transform([text])
-                ngrams_undersc = map(lambda x: x.replace(" ", "_"),
-                                     ngrams.get_feature_names())
-                self.tw_features = self.tw_features.union(set(ngrams_undersc))
-        except ValueError, e:
-            pass
-            # sys.stderr.write(text + "\n")
-            # sys.stderr.write(str(e) + "\n")
-
-        self.tweet = tw_save
-
-    def mentionsFeature(self):
-        entities = self.tweet['entities']
-        if len(entities["user_mentions"]) != 0:
-            self.tw_features.add("_USER_MENTIONS_")
-
-    def hashtagsFeature(self):
-        entities = self.tweet['entities']
-        if len(entities["hashtags"]) != 0:
-                self.tw_features.add("_HASHTAGS_")
-
-    def urlsFeature(self):
-        entities = self.tweet['entities']
-        if len(entities["urls"]) != 0:
-                self.tw_features.add("_URLS_")
-
-    def lengthFeature(self):
-        text = self.tweet['text']
+            features.update(self.tokenizer(analyzer, ngram_range)
+                            .features(text))
+
+    @extractor(CLEANED)
+    def wordTokenize(self, text, record, features):
+        self.tokenize(text, features)
+
+    @extractor(CLEANED)
+    def charTokenize(self, text, record, features):
+        self.tokenize(text, features, analyzer='char_wb', ngram_range=(3, 3))
+
+    @extractor(STRIPPED)
+    def ngrams(self, text, record, features, ngram_range=(2, 2)):
+        if text and -1 != text.find(' '):
+            features.update(self.tokenizer('word', ngram_range, '_')
+                            .features(text))
+
+    @extractor(RAW)
+    def mentionsFeature(self, text, record, features):
+        if len(record.tweet['entities']["user_mentions"]) != 0:
+            features.add("_USER_MENTIONS_")
+
+    @extractor(RAW)
+    def hashtagsFeature(self, text, record, features):
+        if len(record.tweet['entities']["hashtags"]) != 0:
+            features.add("_HASHTAGS_")
+
+    @extractor(RAW)
+    def urlsFeature(self, text, record, features):
+        if len(record.tweet['entities']["urls"]) != 0:
+            features.add("_URLS_")
+
+    @extractor(RAW)
+    def lengthFeature(self, text, record, features):
         if len(text) < self.mini:
-            self.tw_features.add("_TW_SMALL_")
+            features.add("_TW_SMALL_")
         elif len(text) < self.maxi:
-            self.tw_features.add("_TW_MEDIUM_")
+            features.add("_TW_MEDIUM_")
         else:
-            self.tw_features.add("_TW_LARGE_")
+            features.add("_TW_LARGE_")
 
-    def caseFeature(self):
-        text = self.tweet['text']
+    @extractor(RAW)
+    def caseFeature(self, text, record, features):
         caps = float(sum(1 for c in text if c.isupper()))
         length = float(len(text))
         if length != 0 and caps/length > 0.8:
-            self.tw_features.add("_ALL_CAPS_")
+            features.add("_ALL_CAPS_")
 
-    def liwcFeature(self):
+    @extractor(RAW)
+    def liwcFeature(self, text, record, features):
         if self.lexicon:
-            words = self.tweet['text'].split()
-            categories = self.lexicon.categories_for_tokens(words)
-            if categories:
-                features = reduce(lambda x, y: set(x).union(set(y)), categories)
-                self.tw_features = self.tw_features.union(features)
+            # the raw tokens are not added to the shared vocabulary, the
+            # lexicon memoizing a bounded number of them
+            for categories in self.lexicon.categories_for_tokens(text.split()):
+                features.update(categories)
 
-    def extractFeatures(self, tw):
-        check_func = (f for f in self.func_list
-                      if f in dir(self) and callable(getattr(self, f)))
-        # filter on retweets
-        self.tweet = tw
-        tw_rt = self.tweet['text'].find("RT") != -1
-        if not self.keep_rt and tw_rt:
-            return False
+    def extract(self, tw):
+        """
+        Applies the extractors to a tweet. If the func_list has a 'clean'
+        step, the text of the tweet is replaced by its cleaned text once the
+        features are extracted.
 
-        # apply features extractors
-        for f in check_func:
-            getattr(self, f)()
+        Return value:
+        The features of the tweet joined by spaces, None if the tweet is a
+        retweet and retweets are not kept.
+        """
+        features = self.extract_set(tw)
+        if features is None:
+            return None
+        return " ".join(features)
 
-        self.features.append(" ".join(self.tw_features))
+    def extract_set(self, tw):
+        """
+        Applies the extractors to a tweet like extract.
+
+        Return value:
+        The set of the features of the tweet, None if the tweet is a retweet
+        and retweets are not kept.
+        """
+        if not self.keep_rt and tw['text'].find("RT") != -1:
+            return None
+        record = self.cleaner.record(tw, self.cleaning)
+        features = set()
+        for f, view in self.extractors:
+            f(view(record), record, features)
+        if self.cleaning:
+            # kept for the display of the tweets
+            tw['text'] = record.cleaned
+        return features
+
+    def extractFeatures(self, tw):
+        features = self.extract(tw)
+        if features is None:
+            return False
+        self.features.append(features)
         return True
 
-    def extractLabels(self, tw):
-        if self.extract_labels:
+    def label(self, tw):
+        """
+        Return value:
+        The labels of a tweet as a dictionary, None if no labels are
+        extracted.
+        """
+        if not self.extract_labels:
+            return None
+        d = {}
+        for l in self.extract_labels:
+            d[l] = int(tw[l])
+        if self.labels_reduce_f:
+            labels = d.values()
             d = {}
-            for l in self.extract_labels:
-                d[l] = int(tw[l])
-            if self.labels_reduce_f:
-                labels = d.values()
-                d = {}
-                d['reduced'] = reduce(self.labels_reduce_f, labels)
+            d['reduced'] = reduce(self.labels_reduce_f, labels)
+        return d
+
+    def extractLabels(self, tw):
+        d = self.label(tw)
+        if d is not None:
             self.labels.append(d)
 
-    def run(self):
+    def chunks(self):
+        """
+        Yields the tweets of the corpus by lists of chunk_size tweets.
+        """
+        chunk = []
+        for tw in self.corpus:
+            chunk.append(tw)
+            if len(chunk) >= self.chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def run_chunk(self, chunk, transform=None):
+        """
+        Extracts the features and the labels of a list of tweets.
+
+        Return value:
+        The tuple (features, labels, twids, names) of the tweets. features is
+        the list of the features strings of the tweets, or their hashed
+        matrix if the builder hashes the features, transformed by the given
+        function if any. names maps the columns of the hashed matrix to
+        features (see FeaturesHasher.transform), None if the features are not
+        hashed.
+        """
+        extract = self.extract_set if self.hasher else self.extract
+        features, labels, twids = [], [], []
+        for tw in chunk:
+            f = extract(tw)
+            if f is None:
+                twids.append(0)
+                continue
+            features.append(f)
+            d = self.label(tw)
+            if d is not None:
+                labels.append(d)
+            twids.append(1)
+        names = None
+        if self.hasher:
+            names = {}
+            features = self.hasher.transform(features, names)
+        if transform is not None:
+            features = transform(features)
+        return features, labels, twids, names
+
+    def blocks(self, transform=None):
+        """
+        Yields the tuples (features, labels, twids, names) of the chunks of the
+        corpus (see run_chunk) in the order of the corpus. The chunks are
+        processed by a pool of workers processes if the builder has several
+        workers and the corpus more than one chunk.
+        """
+        chunks = self.chunks()
+        first = next(chunks, None)
+        if first is None:
+            return
+        if self.workers == 1 or len(first) < self.chunk_size:
+            for chunk in chain([first], chunks):
+                yield self.run_chunk(chunk, transform)
+            return
+        workers = self.workers if self.workers \
+            else multiprocessing.cpu_count()
+
+        # the workers are forked after the chunks are read, so only the
+        # numbers of the chunks are sent to them
+        chunks = list(chain([first], chunks))
+
+        def work(tasks, results):
+            if self.profiler:
+                # durations inherited from the parent process, already counted
+                self.profiler.drain()
+            for i in iter(tasks.get, None):
+                try:
+                    block = self.run_chunk(chunks[i], transform)
+                    # texts cleaned in place by the 'clean' step
+                    results.put((i, block, [tw['text'] for tw in chunks[i]],
+                                 self.profiler.drain()
+                                 if self.profiler else None))
+                except Exception, e:
+                    results.put((i, e, None, None))
+            results.put(None)
+
+        pending = {}    # blocks received before their turn
+        current = 0
+        for i, block, texts, durations in run_pool(work, range(len(chunks)),
+                                                   workers, 2 * workers):
+            if isinstance(block, Exception):
+                raise Exception("Error while extracting the features of "
+                                "chunk %d: %s" % (i, block))
+            for tw, text in zip(chunks[i], texts):
+                tw['text'] = text
+            if durations:
+                self.profiler.merge(durations)
+            pending[i] = block
+            while current in pending:
+                yield pending.pop(current)
+                current += 1
+
+    def batches(self, transform=None):
+        """
+        Yields the features of the tweets of the corpus by batches of
+        chunk_size tweets, as the tweets are read. Only one batch is kept in
+        memory, so that the corpus can be unbounded, e.g. the tweets printed
+        by 'stream collect'. The batches are built by the current process.
+
+        Parameters:
+        transform - function applied to the features of every batch, e.g.
+                    the transform method of a fitted pipeline
+
+        Return value:
+        An iterator over the FeaturesBatch of the corpus.
+        """
+        for chunk in self.chunks():
+            features, labels, twids, names = self.run_chunk(chunk, transform)
+            yield FeaturesBatch(chunk, features, labels, twids)
+
+    def records(self):
+        """
+        Yields the pairs (tweet, features) of the tweets of the corpus as the
+        tweets are read, features being the features string of the tweet,
+        the set of its features if the builder hashes them, or None if the
+        tweet is filtered.
+        """
+        extract = self.extract_set if self.hasher else self.extract
+        for tw in self.corpus:
+            yield tw, extract(tw)
+
+    def run(self, transform=None):
+        """
+        Extracts the features and the labels of the tweets of the corpus.
+
+        Parameters:
+        transform - function applied to the list of the features of every
+                    chunk of the corpus, e.g. the transform method of a
+                    fitted vectorizer, in the worker processes when there
+                    are several ones.
+
+        Return value:
+        The triple (features, labels, twids): features is the list of the
+        features of the tweets joined by spaces, the CSR matrix of the hashed
+        features if the builder hashes them, or the list of the transformed
+        chunks if transform is given, e.g. sparse matrices to stack. labels
+        is the list of the labels of the tweets and twids the list of flags
+        set to 1 for the tweets that were not filtered.
+        """
         self.features = []
         self.labels = []
         self.twids = []
-        for tw in self.corpus:
-            self.tw_features = set()
-            if self.extractFeatures(tw):
-                self.extractLabels(tw)
-                self.twids.append(1)
+        self.names = {} if self.hasher else None
+        for features, labels, twids, names in self.blocks(transform):
+            if transform is not None or self.hasher:
+                self.features.append(features)
             else:
-                self.twids.append(0)
+                self.features.extend(features)
+            self.labels.extend(labels)
+            self.twids.extend(twids)
+            if names:
+                # the first feature of a column in the order of the corpus
+                for c, f in names.iteritems():
+                    self.names.setdefault(c, f)
+        if self.hasher and transform is None:
+            self.features = sp.vstack(self.features, format='csr') \
+                if self.features \
+                else sp.csr_matrix((0, self.hasher.n_features))
         return self.features, self.labels, self.twids
 
 
 class Cleaner():
     """
-    Cleaner of corpus
+    Cleaner of corpus. The stopwords, emoticons and tokens are interned in
+    the vocabulary of the cleaner, which can be shared with other structures.
+    Emoticons are replaced in a single pass over the text, the longest
+    emoticon being replaced when several ones match at the same position.
+    When no emoticon contains another one, this gives the same text as
+    replacing them one after the other:
+
+    >>> import tempfile
+    >>> tf = tempfile.NamedTemporaryFile()
+    >>> tf.write("happy\\t:)\\nhappy\\t:-)\\nhappy\\t(:\\nsad\\t:(\\nsad\\t:-(\\n"
+    ...          "sad\\t:'(\\nlove\\t<3\\nwink\\t;)\\nwink\\t;-)\\n")
+    >>> tf.flush()
+    >>> cl = Cleaner(emoticons=tf.name, rm_punctuation=False)
+    >>> def replace_one_by_one(text):
+    ...     for emo in cl.emoticons:
+    ...         for entry in cl.emoticons[emo]:
+    ...             text = string.replace(text, entry, " " + emo + " ")
+    ...     return text
+    >>> texts = [u"great run today :) <3", u"so tired :-( :'(", u";-);)(:",
+    ...          u"no emoticon here", u":):(:-):-(<3<3", u""]
+    >>> [cl.replace_emoticons(t) for t in texts] == map(replace_one_by_one,
+    ...                                                  texts)
+    True
+    >>> cl.replace_emoticons(u"a :) b")
+    u'a  happy  b'
+
+    Otherwise the longest emoticon wins, whereas replacing them one after
+    the other depends on their order, e.g. replacing :) before :)) leaves
+    ' happy )' instead of ' veryhappy ':
+
+    >>> tf2 = tempfile.NamedTemporaryFile()
+    >>> tf2.write("happy\\t:)\\nveryhappy\\t:))\\n")
+    >>> tf2.flush()
+    >>> Cleaner(emoticons=tf2.name).replace_emoticons(u"yes :)) :)")
+    u'yes  veryhappy   happy '
+    >>> string.replace(u"yes :)) :)", ":)", " happy ")
+    u'yes  happy )  happy '
+
+    Mentions, urls and unicode characters are removed with fewer passes than
+    one per kind, and the punctuation with a translation table, which gives
+    the same texts as removing them one after the other:
+
+    >>> def preprocess_one_by_one(text):
+    ...     text = text.lower()
+    ...     for regex in (cl.mentions_regex, cl.url_regex, cl.unicode_regex):
+    ...         text = re.sub(regex, '', text)
+    ...     text = replace_one_by_one(text)
+    ...     text = ''.join(c for c in text if c not in cl.exclude)
+    ...     return re.sub(cl.stem_regex, r'\\1\\1', text)
+    >>> cl.rm_punctuation = True
+    >>> texts += [u"@Bob see http://t.co/x;@bob www.ab.com/(x) RT!!",
+    ...           u"caf\\xe9http://t.co/a \\u2764 @al-@b_c.d e@f soooo :-)",
+    ...           "plain str, with punctuation... and http://t.co/z"]
+    >>> [cl.preprocess(t) for t in texts] == map(preprocess_one_by_one, texts)
+    True
+    >>> cl.clean_many(texts) == [cl.clean_tw({'text': t})['text'] for t in texts]
+    True
+
+    The views of a tweet are built in a single pass by record, whatever the
+    punctuation option is:
+
+    >>> def views(text):
+    ...     r = cl.record({'text': text})
+    ...     return r.cleaned, r.stripped, r.tokens
+    >>> def views_one_by_one(text):
+    ...     rm_punctuation = cl.rm_punctuation
+    ...     cl.rm_punctuation = True
+    ...     stripped = cl.clean_text(text)
+    ...     cl.rm_punctuation = rm_punctuation
+    ...     cleaned = cl.clean_text(text)
+    ...     return cleaned, stripped, tuple(cleaned.split())
+    >>> map(views, texts) == map(views_one_by_one, texts)
+    True
+    >>> cl.rm_punctuation = False
+    >>> map(views, texts) == map(views_one_by_one, texts)
+    True
+    >>> views(u"Sooo HAPPY!!! :)")
+    (u'soo happy!!! happy', u'soo happy happy', (u'soo', u'happy!!!', u'happy'))
+
+    A cleaner given a memo cleans every text once per set of options, the
+    memo being shareable by the cleaners built with the same files:
+
+    >>> memo = LRUCache(100)
+    >>> mcl = Cleaner(emoticons=tf.name, rm_punctuation=False, memo=memo)
+    >>> def memo_views(text):
+    ...     r = mcl.record({'text': text})
+    ...     return r.cleaned, r.stripped, r.tokens
+    >>> map(memo_views, texts + texts) == map(views, texts + texts)
+    True
+    >>> cl.rm_punctuation = mcl.rm_punctuation = True
+    >>> map(mcl.clean_text, texts + texts) == map(cl.clean_text, texts + texts)
+    True
+    >>> memo.hits, memo.misses
+    (18, 18)
     """
     def __init__(self, stopwords=None, emoticons=None, rm_urls=True,
-                 rm_mentions=True, rm_punctuation=True, rm_unicode=True):
-        self.stopwords = LSF(stopwords).tolist()
-        self.emoticons = TSV(emoticons).keys
+                 rm_mentions=True, rm_punctuation=True, rm_unicode=True,
+                 vocabulary=None, memo=None):
+        self.vocabulary = vocabulary if vocabulary is not None \
+            else Vocabulary()
+        self.stopwords = LSF(stopwords, self.vocabulary).tovocabulary()
+        self.emoticons = TSV(emoticons, self.vocabulary).keys
+        # tag of every emoticon, the first category of an emoticon wins
+        self.emoticons_tags = {}
+        for emo in self.emoticons:
+            for entry in self.emoticons[emo]:
+                self.emoticons_tags.setdefault(entry, " " + emo + " ")
+        self.emoticons_regex = None
+        if self.emoticons_tags:
+            self.emoticons_regex = re.compile(trie_regex(self.emoticons_tags))
         self.url_regex = re.compile(r'''(?i)\b((?:https?://|www\d{0,3}[.]|[a-z0-9.\-]+[.][a-z]{2,4}/)(?:[^\s()<>]+|\(([^\s()<>]+|(\([^\s()<>]+\)))*\))+(?:\(([^\s()<>]+|(\([^\s()<>]+\)))*\)|[^\s`()\[\]{};:'"<>?]))''')
         self.mentions_regex = re.compile(r'''(?<=^|(?<=[^a-zA-Z0-9-_\.]))@([A-Za-z]+[A-Za-z0-9_]+)''')
         self.unicode_regex = re.compile(r'''[^\x00-\x7F]''')
         self.stem_regex = re.compile(r'''([a-zA-Z])\1{2,}''', re.DOTALL)
         self.exclude = set(string.punctuation)
+        # deletion tables of the punctuation for str.translate
+        self.punctuation_table = dict((ord(c), None) for c in self.exclude)
+        self.removal_regexes = {}
         self.rm_urls = rm_urls
         self.rm_mentions = rm_mentions
         self.rm_punctuation = rm_punctuation
         self.rm_unicode = rm_unicode
         self.original_corpus = []
         self.cleaned_corpus = []
+        # LRUCache of the cleaned texts and views, None to clean every text
+        self.memo = memo
+        # the cleaners with the same stopwords and emoticons share a memo,
+        # their stopwords and emoticons being part of the keys of the memo.
+        # The signatures are interned so that the keys are compared by
+        # identity.
+        signature = (frozenset(self.stopwords),
+                     frozenset(self.emoticons_tags.iteritems()))
+        self.signature = Cleaner.signatures.setdefault(signature, signature)
+
+    # signatures of the cleaners, see __init__
+    signatures = {}
+
+    # steps timed by a profiler, see profile
+    steps = ['remove_mentions', 'remove_urls', 'replace_emoticons',
+             'strip_punctuation', 'stem', 'tokenize', 'record', 'clean_text']
+
+    def profile(self, profiler):
+        """
+        Records the durations of the steps of the cleaner in the stages
+        'cleaner.<step>' of the given profiler (see profiling.Profiler).
+        """
+        for step in self.steps:
+            setattr(self, step, profiler.timed('cleaner.' + step,
+                                               getattr(Cleaner, step)
+                                               .__get__(self)))
 
     def preprocess(self, text):
         """
@@ -210,28 +845,78 @@ class Cleaner():
         repeated more than three times by two of the same character and
         replaces emoticons with tags.
         """
-        text = text.lower()
+        text = self.normalize(text)
+        if self.rm_punctuation:
+            text = self.strip_punctuation(text)
+        return self.stem(text)
 
-        if self.rm_mentions:
-            text = re.sub(self.mentions_regex, '', text)
+    def normalize(self, text):
+        """
+        First steps of preprocess: lowercases a string, removes its mentions,
+        urls and unicode characters and replaces its emoticons.
+        """
+        text = text.lower()
 
-        if self.rm_urls:
-            text = re.sub(self.url_regex, '', text)
+        # mentions can only be found around an @
+        if self.rm_mentions and '@' in text:
+            text = self.remove_mentions(text)
 
-        if self.rm_unicode:
-            text = re.sub(self.unicode_regex, '', text)
+        if self.rm_urls or self.rm_unicode:
+            text = self.remove_urls(text)
 
         # replace emoticons
         if self.emoticons:
-            for emo in self.emoticons:
-                for entry in self.emoticons[emo]:
-                    text = string.replace(text, entry, " " + emo + " ")
+            text = self.replace_emoticons(text)
+        return text
 
-        if self.rm_punctuation:
-            text = ''.join(c for c in text if c not in self.exclude)
+    def remove_mentions(self, text):
+        return self.mentions_regex.sub('', text)
 
-        text = re.sub(self.stem_regex, r'\1\1', text)
-        return text
+    def remove_urls(self, text):
+        """
+        Removes the urls and the unicode characters of a string in a single
+        pass, according to the options of the cleaner.
+        """
+        return self.removal_regex().sub('', text)
+
+    def stem(self, text):
+        """
+        Replaces the letters repeated more than twice by two letters.
+        """
+        return self.stem_regex.sub(r'\1\1', text)
+
+    def strip_punctuation(self, text):
+        if type(text) == unicode:
+            return text.translate(self.punctuation_table)
+        return text.translate(None, string.punctuation)
+
+    def removal_regex(self):
+        """
+        Return value:
+        A regular expression matching the urls if rm_urls is set, and the
+        unicode characters if rm_unicode is set, None if both are unset.
+        Removing its matches gives the same text as removing the urls and then
+        the unicode characters, as urls cannot start with a unicode character.
+        """
+        key = (self.rm_urls, self.rm_unicode)
+        if key not in self.removal_regexes:
+            patterns = []
+            if self.rm_urls:
+                patterns.append(self.url_regex.pattern)
+            if self.rm_unicode:
+                patterns.append(self.unicode_regex.pattern)
+            self.removal_regexes[key] = re.compile('|'.join(patterns)) \
+                if patterns else None
+        return self.removal_regexes[key]
+
+    def replace_emoticons(self, text):
+        """
+        Replaces the emoticons of a string with their tags.
+        """
+        if not self.emoticons_regex:
+            return text
+        tags = self.emoticons_tags
+        return self.emoticons_regex.sub(lambda m: tags[m.group(0)], text)
 
     def tokenize(self, text):
         """
@@ -242,20 +927,108 @@ class Cleaner():
         words = [x for x in words if x]  # remove empty words
         if self.stopwords:
             # remove stopwords
-            words = [x for x in words if x not in self.stopwords]
+            stopwords = self.stopwords
+            words = [x for x in words if x not in stopwords]
         return words
 
+    def memoized(self, kind, text, f):
+        """
+        Return value:
+        f(text), looked up in the memo of the cleaner under the given kind of
+        result, the text and the current options of the cleaner.
+        """
+        key = (kind, self.rm_urls, self.rm_mentions, self.rm_punctuation,
+               self.rm_unicode, self.signature, text)
+        value = self.memo.get(key)
+        if value is None:
+            value = f(text)
+            self.memo.put(key, value)
+        return value
+
+    def clean_text(self, text):
+        """
+        Return value:
+        The cleaned text of a tweet, see clean_tw.
+        """
+        if self.memo is not None:
+            return self.memoized('text', text, self.clean_text_once)
+        return self.clean_text_once(text)
+
+    def clean_text_once(self, text):
+        return " ".join(self.tokenize(self.preprocess(text)))
+
+    def record(self, tw, clean=True):
+        """
+        Builds all the views of a tweet read by the features extractors in a
+        single pass, the steps shared by the views being done once.
+
+        Parameters:
+        tw    - the tweet, which is not modified
+        clean - False to give the raw text as cleaned views
+
+        Return value:
+        The TweetRecord of the tweet.
+        """
+        raw = tw['text']
+        if not clean:
+            return TweetRecord(tw, raw, raw, raw, tuple(raw.split()))
+        if self.memo is not None:
+            views = self.memoized('record', raw, self.views)
+        else:
+            views = self.views(raw)
+        return TweetRecord(tw, raw, *views)
+
+    def views(self, raw):
+        """
+        Return value:
+        The triple (cleaned, stripped, tokens) of the views of a text, see
+        record.
+        """
+        text = self.normalize(raw)
+        stripped = self.strip_punctuation(text)
+        tokens = self.tokenize(self.stem(stripped if self.rm_punctuation
+                                         else text))
+        cleaned = " ".join(tokens)
+        if not self.rm_punctuation:
+            stripped = " ".join(self.tokenize(self.stem(stripped)))
+        else:
+            stripped = cleaned
+        return cleaned, stripped, tuple(tokens)
+
     def clean_tw(self, tw):
         """
         Clean one tweet by removing stopwords, URLs, mentions, and punctuation.
         """
-        text = tw['text']
-        text = self.preprocess(text)
-        words = self.tokenize(text)
-        text = " ".join(words)
-        tw['text'] = text
+        tw['text'] = self.clean_text(tw['text'])
         return tw
 
+    def clean_many(self, texts, workers=1, chunk_size=1000):
+        """
+        Cleans a batch of texts of tweets, as clean_tw does.
+
+        Parameters:
+        texts      - list of the texts to clean
+        workers    - number of processes cleaning the texts, 0 or None to use
+                     one process per CPU
+        chunk_size - number of texts sent at once to a process
+
+        Return value:
+        The list of the cleaned texts, in the order of the given texts.
+        """
+        if workers == 1 or len(texts) <= chunk_size:
+            return map(self.clean_text, texts)
+        workers = workers if workers else multiprocessing.cpu_count()
+
+        def work(tasks, results):
+            for i, chunk in iter(tasks.get, None):
+                results.put((i, map(self.clean_text, chunk)))
+            results.put(None)
+
+        chunks = [(i, texts[i:i + chunk_size])
+                  for i in xrange(0, len(texts), chunk_size)]
+        cleaned = dict(run_pool(work, chunks, workers, 2 * workers))
+        return [t for i, chunk in chunks for t in cleaned[i]]
+
     def clean(self, corpus):
         """
         Clean a corpus given as an iterable by removing stopwords, URLs,
@@ -391,3 +1164,8 @@ class TwitterAPIUser(object):
         req_options = {'user_id': ','.join(uids)}
         r = self.twitterapi.request('users/lookup', req_options)
         return r
+
+
+if (__name__ == '__main__'):
+    import doctest
+    doctest.testmod()
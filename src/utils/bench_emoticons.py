@@ -0,0 +1,62 @@
+"""
+Usage: bench_emoticons.py [--emoticons=N] [--texts=T] [--seed=S]
+
+Compares the time taken to replace the emoticons of random texts one emoticon
+after the other and with the single-pass matcher of the Cleaner.
+
+Options:
+    --emoticons=N   Number of random emoticons [default: 2000]
+    --texts=T       Number of random texts [default: 2000]
+    --seed=S        Seed of the random generator [default: 0]
+"""
+from docopt import docopt
+from sporty.utils import Cleaner
+import random
+import string
+import tempfile
+import time
+
+
+def main():
+    args = docopt(__doc__)
+    rand = random.Random(int(args['--seed']))
+    eyes, noses, mouths = ':;=8xX', ['', '-', "'", 'o', '^'], ')(][DPp/\\|o3*'
+    emoticons = set()
+    while len(emoticons) < int(args['--emoticons']):
+        emoticons.add(rand.choice(eyes) + rand.choice(noses)
+                      + ''.join(rand.choice(mouths)
+                                for i in range(rand.randint(1, 3))))
+    with tempfile.NamedTemporaryFile() as tf:
+        for i, emo in enumerate(sorted(emoticons)):
+            tf.write("emo%d\t%s\n" % (i % 50, emo))
+        tf.flush()
+        cleaner = Cleaner(emoticons=tf.name)
+
+    words = ['run', 'gym', 'happy', 'today', 'so', 'tired'] + list(emoticons)
+    texts = [u' '.join(rand.choice(words) for i in range(15))
+             for j in range(int(args['--texts']))]
+
+    start = time.time()
+    expected = []
+    for text in texts:
+        for emo in cleaner.emoticons:
+            for entry in cleaner.emoticons[emo]:
+                text = string.replace(text, entry, " " + emo + " ")
+        expected.append(text)
+    one_by_one = time.time() - start
+
+    start = time.time()
+    replaced = [cleaner.replace_emoticons(text) for text in texts]
+    single_pass = time.time() - start
+
+    print "emoticons: %d, texts: %d" % (len(emoticons), len(texts))
+    print "one by one:  %.3fs" % one_by_one
+    print "single pass: %.3fs (x%.1f)" % (single_pass,
+                                         one_by_one / max(single_pass, 1e-9))
+    # random emoticons can contain each other, in which case only the
+    # single-pass matcher replaces the longest one
+    print "identical texts: %d/%d" % (sum(a == b for a, b in
+                                          zip(expected, replaced)), len(texts))
+
+if __name__ == '__main__':
+    main()
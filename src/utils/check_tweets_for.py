@@ -1,5 +1,6 @@
 import os.path
 import sys
+from sporty.compression import find
 
 if len(sys.argv) != 3:
     print "Wrong use of the command."
@@ -15,7 +16,7 @@ with open(users_list) as ids:
     for i in ids:
         istr = i.strip()
         total += 1
-        if os.path.isfile(os.path.join(users_dir, istr)):
+        if find(os.path.join(users_dir, istr)):
             found.append(int(istr))
         else:
             missing.append(int(istr))
@@ -6,7 +6,8 @@ if __name__ == '__main__':
     # '/data/1/sporty/nort/3K_labeled'
     # Set commands
     head_cmd = ['mood', 'benchmark', '-t', '../inputs/3K_labeled',
-                '--min-df=3', '--n-folds=10', '--n-examples=30']
+                '--min-df=3', '--n-folds=10', '--n-examples=30',
+                '--features-cache=../cache/features']
     liwc_only_cmd = ['-f', '["liwcFeature"]']
     emo_cmd = ['-e', '../inputs/params/emoticons']
     sw_cmd = ['-s', '../inputs/params/stopwords']